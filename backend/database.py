@@ -6,40 +6,54 @@ and continuous training log ingestion.
 """
 
 import os
+import time
+import asyncio
 import hashlib
+import functools
 import asyncpg
-from datetime import datetime, timedelta
-from typing import Optional
+from bisect import bisect_right
+from datetime import date, datetime, timedelta, timezone
+from typing import AsyncIterator, Optional
 from cryptography.fernet import Fernet
 
+from prediction_engine import KM_PER_MI
+
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
 ENCRYPTION_KEY = os.environ.get("ENCRYPTION_KEY", "")
+# Pool bounds; the max should track expected concurrent requests
+PG_POOL_MIN = int(os.environ.get("PG_POOL_MIN", "5"))
+PG_POOL_MAX = int(os.environ.get("PG_POOL_MAX", "32"))
+# Request-path queries get the pool's 30s command_timeout; exports, view
+# refreshes and table-rewriting migrations pass this instead
+PG_LONG_COMMAND_TIMEOUT = float(os.environ.get("PG_LONG_COMMAND_TIMEOUT", "3600"))
+# SHA-256 state with the "salt:" prefix already absorbed; copied per hash
+_SALTED_SHA256 = hashlib.sha256(
+    os.environ.get("HASH_SALT", "race-prophet-2024").encode() + b":")
 
 # --- Encryption ---
 
-_fernet = None
+# Built once at import; None when no key is configured
+_fernet = Fernet(ENCRYPTION_KEY.encode()) if ENCRYPTION_KEY else None
 
 def get_fernet():
-    global _fernet
-    if _fernet is None and ENCRYPTION_KEY:
-        _fernet = Fernet(ENCRYPTION_KEY.encode())
     return _fernet
 
 def encrypt_token(token: str) -> str:
-    f = get_fernet()
-    if not f:
+    if not _fernet:
         return ""
-    return f.encrypt(token.encode()).decode()
+    return _fernet.encrypt(token.encode()).decode()
 
 def decrypt_token(encrypted: str) -> str:
-    f = get_fernet()
-    if not f or not encrypted:
+    if not _fernet or not encrypted:
         return ""
-    return f.decrypt(encrypted.encode()).decode()
+    return _fernet.decrypt(encrypted.encode()).decode()
 
 
 # --- Connection Pool ---
 
+# asyncpg prepares each distinct query text once per connection and keeps the
+# prepared statement in a per-connection cache. Hot-path SQL lives in _SQL_*
+# module constants so every call hits that cache with the same text.
 pool: Optional[asyncpg.Pool] = None
 
 
@@ -48,19 +62,71 @@ async def init_db():
     if not DATABASE_URL:
         print("WARNING: DATABASE_URL not set, data collection disabled")
         return
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=2, max_size=10)
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=min(PG_POOL_MIN, PG_POOL_MAX),
+        max_size=PG_POOL_MAX,
+        max_inactive_connection_lifetime=300,
+        statement_cache_size=1024,
+        max_cached_statement_lifetime=0,
+        command_timeout=30,
+    )
     await create_tables()
 
 
 async def close_db():
     global pool
+    if _model_stats_refresh and not _model_stats_refresh.done():
+        _model_stats_refresh.cancel()
     if pool:
         await pool.close()
 
 
+# Databases created before is_race/pace_per_km_sec became generated columns
+# hold them as plain ones. The training_log insert no longer binds them, so
+# create_tables converts them at startup, before any activity is ingested.
+_SQL_TRAINING_LOG_IS_GENERATED = """
+    SELECT is_generated = 'ALWAYS' FROM information_schema.columns
+    WHERE table_name = 'training_log' AND column_name = 'is_race'
+"""
+# Covering index for get_training_log_stats. Built only once the derived
+# columns are generated, so an existing database doesn't build it twice.
+_SQL_CREATE_TRAINING_LOG_STATS_INDEX = """
+    CREATE INDEX IF NOT EXISTS idx_training_log_stats ON training_log(athlete_hash, activity_date)
+        INCLUDE (distance_km, pace_per_km_sec, average_heartrate, elevation_gain_m, is_race)
+"""
+_SQL_TRAINING_LOG_GENERATED_MIGRATION = [
+    # Dropping the columns also drops idx_training_log_stats; it is recreated below
+    "ALTER TABLE training_log DROP COLUMN IF EXISTS is_race, DROP COLUMN IF EXISTS pace_per_km_sec",
+    """ALTER TABLE training_log
+        ADD COLUMN is_race BOOLEAN GENERATED ALWAYS AS (COALESCE(workout_type = 1, FALSE)) STORED,
+        ADD COLUMN pace_per_km_sec REAL GENERATED ALWAYS AS (
+            CASE WHEN distance_km > 0 THEN moving_time_seconds / distance_km END
+        ) STORED""",
+    _SQL_CREATE_TRAINING_LOG_STATS_INDEX,
+]
+
+
+async def migrate_training_log_generated(conn) -> bool:
+    """
+    Convert training_log's derived columns to generated ones, all or nothing.
+    Returns False if they already were (e.g. another worker got there first).
+    """
+    async with conn.transaction():
+        await conn.execute(
+            "LOCK TABLE training_log IN ACCESS EXCLUSIVE MODE", timeout=PG_LONG_COMMAND_TIMEOUT)
+        if await conn.fetchval(_SQL_TRAINING_LOG_IS_GENERATED):
+            return False
+        for sql in _SQL_TRAINING_LOG_GENERATED_MIGRATION:
+            await conn.execute(sql, timeout=PG_LONG_COMMAND_TIMEOUT)
+    return True
+
+
 async def create_tables():
     if not pool:
         return
+    # First boot on an existing database builds new indexes and the stats view
+    # over full tables, so this DDL gets the long timeout
     async with pool.acquire() as conn:
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS data_consent (
@@ -75,18 +141,18 @@ async def create_tables():
                 id SERIAL PRIMARY KEY,
                 athlete_hash TEXT NOT NULL,
                 snapshot_date DATE NOT NULL,
-                weeks_of_data INT,
+                weeks_of_data SMALLINT,
                 avg_weekly_miles REAL,
                 peak_weekly_miles REAL,
                 total_miles REAL,
-                total_runs INT,
+                total_runs SMALLINT,
                 avg_run_distance_mi REAL,
                 longest_run_mi REAL,
                 avg_pace_per_mile_sec INT,
                 fastest_pace_per_mile_sec INT,
                 total_elevation_gain_ft REAL,
                 avg_elevation_per_run_ft REAL,
-                runs_with_heartrate INT,
+                runs_with_heartrate SMALLINT,
                 avg_heartrate REAL,
                 weekly_mileage_progression JSONB,
                 age_bucket TEXT,
@@ -178,8 +244,10 @@ async def create_tables():
                 average_heartrate REAL,
                 max_heartrate REAL,
                 workout_type INT,
-                is_race BOOLEAN DEFAULT FALSE,
-                pace_per_km_sec REAL,
+                is_race BOOLEAN GENERATED ALWAYS AS (COALESCE(workout_type = 1, FALSE)) STORED,
+                pace_per_km_sec REAL GENERATED ALWAYS AS (
+                    CASE WHEN distance_km > 0 THEN moving_time_seconds / distance_km END
+                ) STORED,
                 suffer_score INT,
                 strava_activity_id BIGINT,
                 created_at TIMESTAMPTZ DEFAULT NOW(),
@@ -238,102 +306,172 @@ async def create_tables():
             CREATE INDEX IF NOT EXISTS idx_snapshots_athlete ON training_snapshots(athlete_hash);
             CREATE INDEX IF NOT EXISTS idx_results_athlete ON race_results(athlete_hash);
             CREATE INDEX IF NOT EXISTS idx_results_distances ON race_results(ref_distance_km, goal_distance_km);
-            CREATE INDEX IF NOT EXISTS idx_pending_athlete ON pending_predictions(athlete_id, status);
-            CREATE INDEX IF NOT EXISTS idx_pending_status ON pending_predictions(status, expires_at);
+            -- Model-accuracy stats only read predicted rows; lets them use an index-only scan
+            CREATE INDEX IF NOT EXISTS idx_results_pred ON race_results(model_version)
+                INCLUDE (prediction_error_seconds, prediction_error_pct)
+                WHERE predicted_time_seconds IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS idx_pending_active ON pending_predictions(athlete_id, expires_at)
+                WHERE status = 'pending';
+            CREATE INDEX IF NOT EXISTS idx_pending_expiry ON pending_predictions(expires_at)
+                WHERE status = 'pending';
             CREATE INDEX IF NOT EXISTS idx_tokens_hash ON athlete_tokens(athlete_hash);
-            CREATE INDEX IF NOT EXISTS idx_training_log_athlete ON training_log(athlete_hash, activity_date);
             CREATE INDEX IF NOT EXISTS idx_training_log_activity ON training_log(strava_activity_id);
             CREATE INDEX IF NOT EXISTS idx_users_strava ON users(strava_athlete_id);
             CREATE INDEX IF NOT EXISTS idx_goal_races_user ON goal_races(user_id, status);
             CREATE INDEX IF NOT EXISTS idx_prediction_history_goal ON prediction_history(goal_race_id, created_at);
             CREATE INDEX IF NOT EXISTS idx_prediction_history_user ON prediction_history(user_id);
-        """)
+
+            -- Model-accuracy rollup. PERCENTILE_CONT sorts every predicted result,
+            -- so get_dataset_stats reads this and refreshes it once it goes stale.
+            CREATE MATERIALIZED VIEW IF NOT EXISTS model_stats_mv AS
+                SELECT 1 AS id,
+                    COUNT(*) as n,
+                    AVG(ABS(prediction_error_seconds)) as mae,
+                    AVG(ABS(prediction_error_pct)) as mape,
+                    PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY ABS(prediction_error_seconds)) as median_error,
+                    PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY ABS(prediction_error_seconds)) as p90_error,
+                    NOW() as refreshed_at
+                FROM race_results WHERE predicted_time_seconds IS NOT NULL;
+            -- Unique index is required for REFRESH ... CONCURRENTLY
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_model_stats_mv ON model_stats_mv(id);
+        """, timeout=PG_LONG_COMMAND_TIMEOUT)
+
+        # The migration also builds idx_training_log_stats
+        if not await conn.fetchval(_SQL_TRAINING_LOG_IS_GENERATED):
+            await migrate_training_log_generated(conn)
+        else:
+            await conn.execute(_SQL_CREATE_TRAINING_LOG_STATS_INDEX, timeout=PG_LONG_COMMAND_TIMEOUT)
 
 
 # --- Helpers ---
 
+@functools.lru_cache(maxsize=16384)
 def hash_athlete_id(strava_athlete_id: int) -> str:
-    salt = os.environ.get("HASH_SALT", "race-prophet-2024")
-    raw = f"{salt}:{strava_athlete_id}"
-    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+    # Must stay byte-for-byte stable: every stored athlete_hash (consent rows
+    # included) was derived with salted SHA-256 over "salt:id".
+    h = _SALTED_SHA256.copy()
+    h.update(b"%d" % strava_athlete_id)
+    return h.hexdigest()[:16]
+
+
+# Lower bound of every bucket after the first; _AGE_BUCKETS[i] covers ages
+# from _AGE_CUTOFFS[i-1] up to (but not including) _AGE_CUTOFFS[i].
+_AGE_CUTOFFS = (18, 25, 35, 45, 55, 65)
+_AGE_BUCKETS = ("under-18", "18-24", "25-34", "35-44", "45-54", "55-64", "65+")
 
 
 def age_to_bucket(age: Optional[int]) -> Optional[str]:
     if not age:
         return None
-    if age < 18: return "under-18"
-    elif age <= 24: return "18-24"
-    elif age <= 34: return "25-34"
-    elif age <= 44: return "35-44"
-    elif age <= 54: return "45-54"
-    elif age <= 64: return "55-64"
-    else: return "65+"
+    return _AGE_BUCKETS[bisect_right(_AGE_CUTOFFS, age)]
 
 
 # --- Consent ---
 
+# Consent flips rarely, so lookups are answered from an in-process cache.
+# set_consent/delete_athlete_data update it directly; the TTL bounds how long
+# a change made through another worker process can go unnoticed.
+CONSENT_CACHE_TTL = 300
+CONSENT_CACHE_MAX = 10_000
+_consent_cache: dict = {}  # athlete_hash -> (expires monotonic ts, opted_in)
+
+
+def _cache_consent(athlete_hash: str, opted_in: bool):
+    if len(_consent_cache) >= CONSENT_CACHE_MAX and athlete_hash not in _consent_cache:
+        _consent_cache.pop(next(iter(_consent_cache)))
+    _consent_cache[athlete_hash] = (time.monotonic() + CONSENT_CACHE_TTL, opted_in)
+
+
+_SQL_GET_CONSENT = "SELECT opted_in FROM data_consent WHERE athlete_hash = $1"
+
+
 async def get_consent(strava_athlete_id: int) -> bool:
     if not pool: return False
     athlete_hash = hash_athlete_id(strava_athlete_id)
+    cached = _consent_cache.get(athlete_hash)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
     async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT opted_in FROM data_consent WHERE athlete_hash = $1", athlete_hash)
-        return row["opted_in"] if row else False
+        row = await conn.fetchrow(_SQL_GET_CONSENT, athlete_hash)
+    opted_in = row["opted_in"] if row else False
+    _cache_consent(athlete_hash, opted_in)
+    return opted_in
+
+
+_SQL_UPSERT_CONSENT = """
+    INSERT INTO data_consent (athlete_hash, opted_in, opted_in_at, opted_out_at)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (athlete_hash) DO UPDATE SET
+        opted_in = $2,
+        opted_in_at = CASE WHEN $2 THEN $3 ELSE data_consent.opted_in_at END,
+        opted_out_at = CASE WHEN NOT $2 THEN $4 ELSE data_consent.opted_out_at END
+"""
 
 
 async def set_consent(strava_athlete_id: int, opted_in: bool):
     if not pool: return
     athlete_hash = hash_athlete_id(strava_athlete_id)
-    now = datetime.utcnow()
+    now = datetime.now(timezone.utc)
     async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO data_consent (athlete_hash, opted_in, opted_in_at, opted_out_at)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (athlete_hash) DO UPDATE SET
-                opted_in = $2,
-                opted_in_at = CASE WHEN $2 THEN $3 ELSE data_consent.opted_in_at END,
-                opted_out_at = CASE WHEN NOT $2 THEN $4 ELSE data_consent.opted_out_at END
-        """, athlete_hash, opted_in,
-             now if opted_in else None,
-             now if not opted_in else None)
+        await conn.execute(
+            _SQL_UPSERT_CONSENT, athlete_hash, opted_in,
+            now if opted_in else None,
+            now if not opted_in else None)
+    _cache_consent(athlete_hash, opted_in)
+
+
+# One statement, so the whole purge is atomic and costs a single round-trip.
+# Foreign keys between these tables are checked at the end of the statement.
+_SQL_DELETE_ATHLETE = """
+    WITH
+        -- users delete cascades to goal_races and prediction_history
+        del_users AS (DELETE FROM users WHERE strava_athlete_id = $2),
+        del_results AS (DELETE FROM race_results WHERE athlete_hash = $1),
+        del_snapshots AS (DELETE FROM training_snapshots WHERE athlete_hash = $1),
+        del_log AS (DELETE FROM training_log WHERE athlete_hash = $1),
+        del_pending AS (DELETE FROM pending_predictions WHERE athlete_hash = $1),
+        del_tokens AS (DELETE FROM athlete_tokens WHERE athlete_hash = $1)
+    DELETE FROM data_consent WHERE athlete_hash = $1
+"""
 
 
 async def delete_athlete_data(strava_athlete_id: int):
     if not pool: return
     athlete_hash = hash_athlete_id(strava_athlete_id)
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            # Delete user-related data (cascades to goal_races and prediction_history)
-            await conn.execute("DELETE FROM users WHERE strava_athlete_id = $1", strava_athlete_id)
-            await conn.execute("DELETE FROM race_results WHERE athlete_hash = $1", athlete_hash)
-            await conn.execute("DELETE FROM training_snapshots WHERE athlete_hash = $1", athlete_hash)
-            await conn.execute("DELETE FROM training_log WHERE athlete_hash = $1", athlete_hash)
-            await conn.execute("DELETE FROM pending_predictions WHERE athlete_hash = $1", athlete_hash)
-            await conn.execute("DELETE FROM athlete_tokens WHERE athlete_hash = $1", athlete_hash)
-            await conn.execute("DELETE FROM data_consent WHERE athlete_hash = $1", athlete_hash)
+        await conn.execute(_SQL_DELETE_ATHLETE, athlete_hash, strava_athlete_id)
+    _consent_cache.pop(athlete_hash, None)
 
 
 # --- Token Storage ---
 
+_SQL_UPSERT_TOKENS = """
+    INSERT INTO athlete_tokens (athlete_id, athlete_hash, encrypted_access_token,
+                                encrypted_refresh_token, expires_at, updated_at)
+    VALUES ($1, $2, $3, $4, $5, NOW())
+    ON CONFLICT (athlete_id) DO UPDATE SET
+        encrypted_access_token = $3, encrypted_refresh_token = $4,
+        expires_at = $5, updated_at = NOW()
+"""
+
+_SQL_GET_TOKENS = """
+    SELECT athlete_id, encrypted_access_token, encrypted_refresh_token, expires_at
+    FROM athlete_tokens WHERE athlete_id = $1
+"""
+
+
 async def store_tokens(athlete_id: int, access_token: str, refresh_token: str, expires_at: int):
-    if not pool or not get_fernet(): return
+    if not pool or not _fernet: return
     athlete_hash = hash_athlete_id(athlete_id)
     async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO athlete_tokens (athlete_id, athlete_hash, encrypted_access_token,
-                                        encrypted_refresh_token, expires_at, updated_at)
-            VALUES ($1, $2, $3, $4, $5, NOW())
-            ON CONFLICT (athlete_id) DO UPDATE SET
-                encrypted_access_token = $3, encrypted_refresh_token = $4,
-                expires_at = $5, updated_at = NOW()
-        """, athlete_id, athlete_hash,
+        await conn.execute(_SQL_UPSERT_TOKENS, athlete_id, athlete_hash,
              encrypt_token(access_token), encrypt_token(refresh_token), expires_at)
 
 
 async def get_tokens(athlete_id: int) -> Optional[dict]:
-    if not pool or not get_fernet(): return None
+    if not pool or not _fernet: return None
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM athlete_tokens WHERE athlete_id = $1", athlete_id)
+        row = await conn.fetchrow(_SQL_GET_TOKENS, athlete_id)
         if not row: return None
         return {
             "athlete_id": row["athlete_id"],
@@ -349,105 +487,162 @@ async def update_tokens(athlete_id: int, access_token: str, refresh_token: str,
 
 # --- Training Log (continuous ingestion) ---
 
-async def log_activity(athlete_id: int, activity: dict) -> Optional[int]:
-    """Log a single activity from webhook. Returns log ID or None."""
-    if not pool: return None
-    if not await get_consent(athlete_id): return None
+_TRAINING_LOG_COLUMNS = (
+    "athlete_hash", "activity_date", "distance_km", "moving_time_seconds",
+    "elapsed_time_seconds", "elevation_gain_m", "average_heartrate",
+    "max_heartrate", "workout_type", "suffer_score", "strava_activity_id",
+)
+
+_SQL_INSERT_TRAINING_LOG = f"""
+    INSERT INTO training_log ({", ".join(_TRAINING_LOG_COLUMNS)})
+    SELECT $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11
+    WHERE EXISTS (SELECT 1 FROM data_consent WHERE athlete_hash = $1 AND opted_in)
+    ON CONFLICT (athlete_hash, strava_activity_id) DO UPDATE SET
+        distance_km = EXCLUDED.distance_km,
+        moving_time_seconds = EXCLUDED.moving_time_seconds,
+        elapsed_time_seconds = EXCLUDED.elapsed_time_seconds,
+        elevation_gain_m = EXCLUDED.elevation_gain_m,
+        average_heartrate = EXCLUDED.average_heartrate,
+        max_heartrate = EXCLUDED.max_heartrate,
+        workout_type = EXCLUDED.workout_type
+    RETURNING id
+"""
 
-    athlete_hash = hash_athlete_id(athlete_id)
+
+def _training_log_record(athlete_hash: str, activity: dict) -> Optional[tuple]:
+    """Row for training_log in _TRAINING_LOG_COLUMNS order, or None if unusable."""
     dist_km = activity.get("distance", 0) / 1000
     if dist_km <= 0: return None
 
-    moving_time = activity.get("moving_time", 0)
-    pace = moving_time / dist_km if dist_km > 0 else None
-
     try:
-        activity_date = datetime.strptime(activity.get("start_date", "")[:10], "%Y-%m-%d").date()
+        activity_date = date.fromisoformat(activity.get("start_date", "")[:10])
     except (ValueError, TypeError):
         return None
 
+    return (
+        athlete_hash, activity_date, dist_km, activity.get("moving_time", 0),
+        activity.get("elapsed_time"),
+        activity.get("total_elevation_gain"),
+        activity.get("average_heartrate"),
+        activity.get("max_heartrate"),
+        activity.get("workout_type"),
+        activity.get("suffer_score"),
+        activity.get("id"),
+    )
+
+
+async def log_activity(athlete_id: int, activity: dict) -> Optional[int]:
+    """Log a single activity from webhook. Returns log ID, or None if not opted in."""
+    if not pool: return None
+    record = _training_log_record(hash_athlete_id(athlete_id), activity)
+    if not record: return None
+
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            INSERT INTO training_log (
-                athlete_hash, activity_date, distance_km, moving_time_seconds,
-                elapsed_time_seconds, elevation_gain_m, average_heartrate,
-                max_heartrate, workout_type, is_race, pace_per_km_sec,
-                suffer_score, strava_activity_id
-            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
-            ON CONFLICT (athlete_hash, strava_activity_id) DO UPDATE SET
-                distance_km = EXCLUDED.distance_km,
-                moving_time_seconds = EXCLUDED.moving_time_seconds,
-                elapsed_time_seconds = EXCLUDED.elapsed_time_seconds,
-                elevation_gain_m = EXCLUDED.elevation_gain_m,
-                average_heartrate = EXCLUDED.average_heartrate,
-                max_heartrate = EXCLUDED.max_heartrate,
-                workout_type = EXCLUDED.workout_type,
-                is_race = EXCLUDED.is_race,
-                pace_per_km_sec = EXCLUDED.pace_per_km_sec
-            RETURNING id
-        """,
-            athlete_hash, activity_date, dist_km, moving_time,
-            activity.get("elapsed_time"),
-            activity.get("total_elevation_gain"),
-            activity.get("average_heartrate"),
-            activity.get("max_heartrate"),
-            activity.get("workout_type"),
-            activity.get("workout_type") == 1,
-            pace,
-            activity.get("suffer_score"),
-            activity.get("id"),
-        )
+        row = await conn.fetchrow(_SQL_INSERT_TRAINING_LOG, *record)
         return row["id"] if row else None
 
 
+_MI_PER_KM = 1 / KM_PER_MI
+_FT_PER_M = 3.281
+
+# Weeks are grouped by (calendar year, Monday-start week), the same buckets
+# strftime("%Y-W%W") produces. REAL columns are widened before summing.
+_SQL_TRAINING_LOG_STATS = """
+    WITH runs AS (
+        SELECT activity_date, distance_km::float8 AS km, pace_per_km_sec,
+               average_heartrate, elevation_gain_m, is_race
+        FROM training_log
+        WHERE athlete_hash = $1 AND activity_date >= $2
+    ), weekly AS (
+        SELECT SUM(km) AS km FROM runs
+        GROUP BY date_part('year', activity_date), date_trunc('week', activity_date)
+    )
+    SELECT
+        COUNT(*) AS total_runs,
+        SUM(km) AS total_km,
+        MAX(km) AS longest_km,
+        AVG(pace_per_km_sec) FILTER (WHERE pace_per_km_sec <> 0) AS avg_pace_km,
+        MIN(pace_per_km_sec) FILTER (WHERE pace_per_km_sec <> 0) AS fastest_pace_km,
+        AVG(average_heartrate) FILTER (WHERE average_heartrate <> 0) AS avg_hr,
+        SUM(elevation_gain_m::float8) AS elevation_m,
+        COUNT(*) FILTER (WHERE is_race) AS races,
+        (SELECT MAX(km) FROM weekly) AS peak_week_km
+    FROM runs
+"""
+
+
 async def get_training_log_stats(athlete_hash: str, weeks: int = 16) -> dict:
     """Compute training stats from the continuous log for a given athlete."""
     if not pool:
         return {}
-    cutoff = datetime.utcnow().date() - timedelta(weeks=weeks)
+    cutoff = datetime.now(timezone.utc).date() - timedelta(weeks=weeks)
     async with pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT * FROM training_log
-            WHERE athlete_hash = $1 AND activity_date >= $2
-            ORDER BY activity_date
-        """, athlete_hash, cutoff)
+        row = await conn.fetchrow(_SQL_TRAINING_LOG_STATS, athlete_hash, cutoff)
 
-    if not rows:
+    (total_runs, total_km, longest_km, avg_pace, fastest_pace,
+     avg_hr, elevation_m, races, peak_week_km) = row
+    if not total_runs:
         return {}
 
-    total_km = sum(r["distance_km"] for r in rows)
-    total_mi = total_km / 1.60934
-    distances_mi = [r["distance_km"] / 1.60934 for r in rows]
-    paces = [r["pace_per_km_sec"] * 1.60934 for r in rows if r["pace_per_km_sec"]]
-    heartrates = [r["average_heartrate"] for r in rows if r["average_heartrate"]]
-    elevations = [r["elevation_gain_m"] * 3.281 for r in rows if r["elevation_gain_m"]]
-
-    # Weekly buckets
-    weekly = {}
-    for r in rows:
-        wk = r["activity_date"].strftime("%Y-W%W")
-        weekly[wk] = weekly.get(wk, 0) + r["distance_km"] / 1.60934
-
-    weekly_values = list(weekly.values())
+    total_mi = total_km * _MI_PER_KM
 
     return {
-        "total_runs": len(rows),
+        "total_runs": total_runs,
         "total_miles": round(total_mi, 1),
         "avg_weekly_miles": round(total_mi / weeks, 1),
-        "peak_weekly_miles": round(max(weekly_values), 1) if weekly_values else 0,
-        "avg_run_distance_mi": round(sum(distances_mi) / len(distances_mi), 1),
-        "longest_run_mi": round(max(distances_mi), 1),
-        "avg_pace_per_mile_sec": round(sum(paces) / len(paces)) if paces else None,
-        "fastest_pace_per_mile_sec": round(min(paces)) if paces else None,
-        "avg_heartrate": round(sum(heartrates) / len(heartrates), 1) if heartrates else None,
-        "total_elevation_gain_ft": round(sum(elevations), 0) if elevations else 0,
-        "races_logged": sum(1 for r in rows if r["is_race"]),
+        "peak_weekly_miles": round(peak_week_km * _MI_PER_KM, 1),
+        "avg_run_distance_mi": round(total_mi / total_runs, 1),
+        "longest_run_mi": round(longest_km * _MI_PER_KM, 1),
+        "avg_pace_per_mile_sec": round(avg_pace * KM_PER_MI) if avg_pace is not None else None,
+        "fastest_pace_per_mile_sec": round(fastest_pace * KM_PER_MI) if fastest_pace is not None else None,
+        "avg_heartrate": round(avg_hr, 1) if avg_hr is not None else None,
+        "total_elevation_gain_ft": round(elevation_m * _FT_PER_M, 0) if elevation_m else 0,
+        "races_logged": races,
         "weeks_of_data": weeks,
     }
 
 
 # --- Pending Predictions ---
 
+_PREDICTION_GRACE = timedelta(days=7)   # kept open this long after the race date
+_PREDICTION_TTL = timedelta(days=365)   # lifetime when no race date is given
+
+_SQL_INSERT_PENDING = """
+    INSERT INTO pending_predictions (
+        athlete_id, athlete_hash, snapshot_id,
+        ref_distance_km, ref_time_seconds, ref_date,
+        goal_distance_km, predicted_time_seconds,
+        goal_race_name, goal_race_date, expires_at
+    )
+    SELECT $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11
+    WHERE EXISTS (SELECT 1 FROM data_consent WHERE athlete_hash = $2 AND opted_in)
+    RETURNING id
+"""
+
+# Match window is [race day - 1, race day + match_window_days]; NULL bounds
+# mean no race date, so any date matches
+_SQL_GET_PENDING = """
+    SELECT id, snapshot_id, ref_distance_km, ref_time_seconds, ref_date,
+           goal_distance_km, predicted_time_seconds, goal_race_name,
+           distance_tolerance,
+           goal_race_date - 1 AS match_earliest,
+           goal_race_date + COALESCE(match_window_days, 3) AS match_latest
+    FROM pending_predictions
+    WHERE athlete_id = $1 AND status = 'pending' AND expires_at > NOW()
+    ORDER BY created_at DESC
+"""
+
+_SQL_MATCH_PREDICTION = """
+    UPDATE pending_predictions
+    SET status = 'matched', matched_at = NOW(), matched_activity_id = $2
+    WHERE id = $1
+"""
+
+_SQL_EXPIRE_PREDICTIONS = """
+    UPDATE pending_predictions SET status = 'expired'
+    WHERE status = 'pending' AND expires_at < NOW()
+"""
+
 async def store_pending_prediction(
     athlete_id: int,
     snapshot_id: Optional[int],
@@ -461,30 +656,22 @@ async def store_pending_prediction(
 ) -> Optional[int]:
     if not pool: return None
     athlete_hash = hash_athlete_id(athlete_id)
+    race_day = date.fromisoformat(goal_race_date) if goal_race_date else None
 
     # Expiration: 7 days after race date if provided, otherwise 365 days
-    if goal_race_date:
-        race_dt = datetime.strptime(goal_race_date, "%Y-%m-%d")
-        expires_at = race_dt + timedelta(days=7)
+    if race_day:
+        expires_at = datetime.combine(race_day, datetime.min.time(), timezone.utc) + _PREDICTION_GRACE
     else:
-        expires_at = datetime.utcnow() + timedelta(days=365)
+        expires_at = datetime.now(timezone.utc) + _PREDICTION_TTL
 
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            INSERT INTO pending_predictions (
-                athlete_id, athlete_hash, snapshot_id,
-                ref_distance_km, ref_time_seconds, ref_date,
-                goal_distance_km, predicted_time_seconds,
-                goal_race_name, goal_race_date, expires_at
-            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
-            RETURNING id
-        """,
+        row = await conn.fetchrow(
+            _SQL_INSERT_PENDING,
             athlete_id, athlete_hash, snapshot_id,
             ref_distance_km, ref_time_seconds,
-            datetime.strptime(ref_date, "%Y-%m-%d").date() if ref_date else None,
+            date.fromisoformat(ref_date) if ref_date else None,
             goal_distance_km, predicted_time_seconds,
-            goal_race_name,
-            datetime.strptime(goal_race_date, "%Y-%m-%d").date() if goal_race_date else None,
+            goal_race_name, race_day,
             expires_at,
         )
         return row["id"] if row else None
@@ -493,88 +680,101 @@ async def store_pending_prediction(
 async def get_pending_predictions(athlete_id: int) -> list:
     if not pool: return []
     async with pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT * FROM pending_predictions
-            WHERE athlete_id = $1 AND status = 'pending' AND expires_at > NOW()
-            ORDER BY created_at DESC
-        """, athlete_id)
+        rows = await conn.fetch(_SQL_GET_PENDING, athlete_id)
         return [dict(r) for r in rows]
 
 
 async def match_prediction(prediction_id: int, activity_id: int):
     if not pool: return
     async with pool.acquire() as conn:
-        await conn.execute("""
-            UPDATE pending_predictions
-            SET status = 'matched', matched_at = NOW(), matched_activity_id = $2
-            WHERE id = $1
-        """, prediction_id, activity_id)
+        await conn.execute(_SQL_MATCH_PREDICTION, prediction_id, activity_id)
 
 
 async def expire_old_predictions():
     if not pool: return
     async with pool.acquire() as conn:
-        await conn.execute("""
-            UPDATE pending_predictions SET status = 'expired'
-            WHERE status = 'pending' AND expires_at < NOW()
-        """)
+        await conn.execute(_SQL_EXPIRE_PREDICTIONS)
 
 
 # --- Training Snapshots ---
 
+# Snapshot feature columns, in the order they are taken from training_data
+_SNAPSHOT_FEATURES = (
+    "weeks_of_data", "avg_weekly_miles", "peak_weekly_miles",
+    "total_miles", "total_runs", "avg_run_distance_mi", "longest_run_mi",
+    "avg_pace_per_mile_sec", "fastest_pace_per_mile_sec",
+    "total_elevation_gain_ft", "avg_elevation_per_run_ft",
+    "runs_with_heartrate", "avg_heartrate",
+    "weekly_mileage_progression",
+)
+
+_SQL_INSERT_SNAPSHOT = """
+    INSERT INTO training_snapshots (
+        athlete_hash, snapshot_date,
+        weeks_of_data, avg_weekly_miles, peak_weekly_miles,
+        total_miles, total_runs, avg_run_distance_mi, longest_run_mi,
+        avg_pace_per_mile_sec, fastest_pace_per_mile_sec,
+        total_elevation_gain_ft, avg_elevation_per_run_ft,
+        runs_with_heartrate, avg_heartrate,
+        weekly_mileage_progression,
+        age_bucket, experience_level, gender
+    )
+    SELECT $1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14,$15,$16,$17,$18,$19
+    WHERE EXISTS (SELECT 1 FROM data_consent WHERE athlete_hash = $1 AND opted_in)
+    ON CONFLICT (athlete_hash, snapshot_date) DO UPDATE SET
+        weeks_of_data=EXCLUDED.weeks_of_data, avg_weekly_miles=EXCLUDED.avg_weekly_miles,
+        peak_weekly_miles=EXCLUDED.peak_weekly_miles, total_miles=EXCLUDED.total_miles,
+        total_runs=EXCLUDED.total_runs, avg_run_distance_mi=EXCLUDED.avg_run_distance_mi,
+        longest_run_mi=EXCLUDED.longest_run_mi,
+        avg_pace_per_mile_sec=EXCLUDED.avg_pace_per_mile_sec,
+        fastest_pace_per_mile_sec=EXCLUDED.fastest_pace_per_mile_sec,
+        total_elevation_gain_ft=EXCLUDED.total_elevation_gain_ft,
+        avg_elevation_per_run_ft=EXCLUDED.avg_elevation_per_run_ft,
+        runs_with_heartrate=EXCLUDED.runs_with_heartrate,
+        avg_heartrate=EXCLUDED.avg_heartrate,
+        weekly_mileage_progression=EXCLUDED.weekly_mileage_progression,
+        age_bucket=EXCLUDED.age_bucket, experience_level=EXCLUDED.experience_level,
+        gender=EXCLUDED.gender
+    RETURNING id
+"""
+
+
 async def store_training_snapshot(
     strava_athlete_id: int, training_data: dict,
     age: Optional[int] = None, experience_level: Optional[str] = None,
     gender: Optional[str] = None,
 ) -> Optional[int]:
     if not pool: return None
-    if not await get_consent(strava_athlete_id): return None
     athlete_hash = hash_athlete_id(strava_athlete_id)
-    today = datetime.utcnow().date()
+    today = datetime.now(timezone.utc).date()
 
+    # Consent is checked inside the INSERT so the whole write is one round-trip;
+    # no row (and no id) comes back if the athlete hasn't opted in.
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            INSERT INTO training_snapshots (
-                athlete_hash, snapshot_date,
-                weeks_of_data, avg_weekly_miles, peak_weekly_miles,
-                total_miles, total_runs, avg_run_distance_mi, longest_run_mi,
-                avg_pace_per_mile_sec, fastest_pace_per_mile_sec,
-                total_elevation_gain_ft, avg_elevation_per_run_ft,
-                runs_with_heartrate, avg_heartrate,
-                weekly_mileage_progression,
-                age_bucket, experience_level, gender
-            ) VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14,$15,$16,$17,$18,$19)
-            ON CONFLICT (athlete_hash, snapshot_date) DO UPDATE SET
-                weeks_of_data=EXCLUDED.weeks_of_data, avg_weekly_miles=EXCLUDED.avg_weekly_miles,
-                peak_weekly_miles=EXCLUDED.peak_weekly_miles, total_miles=EXCLUDED.total_miles,
-                total_runs=EXCLUDED.total_runs, avg_run_distance_mi=EXCLUDED.avg_run_distance_mi,
-                longest_run_mi=EXCLUDED.longest_run_mi,
-                avg_pace_per_mile_sec=EXCLUDED.avg_pace_per_mile_sec,
-                fastest_pace_per_mile_sec=EXCLUDED.fastest_pace_per_mile_sec,
-                total_elevation_gain_ft=EXCLUDED.total_elevation_gain_ft,
-                avg_elevation_per_run_ft=EXCLUDED.avg_elevation_per_run_ft,
-                runs_with_heartrate=EXCLUDED.runs_with_heartrate,
-                avg_heartrate=EXCLUDED.avg_heartrate,
-                weekly_mileage_progression=EXCLUDED.weekly_mileage_progression,
-                age_bucket=EXCLUDED.age_bucket, experience_level=EXCLUDED.experience_level,
-                gender=EXCLUDED.gender
-            RETURNING id
-        """,
+        row = await conn.fetchrow(
+            _SQL_INSERT_SNAPSHOT,
             athlete_hash, today,
-            training_data.get("weeks_of_data"), training_data.get("avg_weekly_miles"),
-            training_data.get("peak_weekly_miles"), training_data.get("total_miles"),
-            training_data.get("total_runs"), training_data.get("avg_run_distance_mi"),
-            training_data.get("longest_run_mi"), training_data.get("avg_pace_per_mile_sec"),
-            training_data.get("fastest_pace_per_mile_sec"),
-            training_data.get("total_elevation_gain_ft"),
-            training_data.get("avg_elevation_per_run_ft"),
-            training_data.get("runs_with_heartrate"), training_data.get("avg_heartrate"),
-            training_data.get("weekly_mileage_progression"),
+            *map(training_data.get, _SNAPSHOT_FEATURES),
             age_to_bucket(age), experience_level, gender,
         )
         return row["id"] if row else None
 
 
+_SQL_INSERT_RACE_RESULT = """
+    INSERT INTO race_results (
+        snapshot_id, athlete_hash,
+        ref_distance_km, ref_time_seconds, ref_date,
+        goal_distance_km, goal_time_seconds, goal_date,
+        goal_elevation_gain_ft, predicted_time_seconds,
+        prediction_error_seconds, prediction_error_pct,
+        model_version, source
+    )
+    SELECT $1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14
+    WHERE EXISTS (SELECT 1 FROM data_consent WHERE athlete_hash = $2 AND opted_in)
+    RETURNING id
+"""
+
+
 async def store_race_result(
     strava_athlete_id: int, snapshot_id: Optional[int],
     ref_distance_km: float, ref_time_seconds: int, ref_date: Optional[str],
@@ -584,7 +784,6 @@ async def store_race_result(
     model_version: str = "riegel_v1", source: str = "manual",
 ) -> Optional[int]:
     if not pool: return None
-    if not await get_consent(strava_athlete_id): return None
     athlete_hash = hash_athlete_id(strava_athlete_id)
 
     prediction_error = prediction_error_pct = None
@@ -593,22 +792,13 @@ async def store_race_result(
         prediction_error_pct = (prediction_error / goal_time_seconds) * 100
 
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            INSERT INTO race_results (
-                snapshot_id, athlete_hash,
-                ref_distance_km, ref_time_seconds, ref_date,
-                goal_distance_km, goal_time_seconds, goal_date,
-                goal_elevation_gain_ft, predicted_time_seconds,
-                prediction_error_seconds, prediction_error_pct,
-                model_version, source
-            ) VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14)
-            RETURNING id
-        """,
+        row = await conn.fetchrow(
+            _SQL_INSERT_RACE_RESULT,
             snapshot_id, athlete_hash,
             ref_distance_km, ref_time_seconds,
-            datetime.strptime(ref_date, "%Y-%m-%d").date() if ref_date else None,
+            date.fromisoformat(ref_date) if ref_date else None,
             goal_distance_km, goal_time_seconds,
-            datetime.strptime(goal_date, "%Y-%m-%d").date(),
+            date.fromisoformat(goal_date),
             goal_elevation_gain_ft, predicted_time_seconds,
             prediction_error, prediction_error_pct, model_version, source,
         )
@@ -630,73 +820,127 @@ async def store_webhook_state(subscription_id: int, verify_token: str):
 async def get_webhook_state() -> Optional[dict]:
     if not pool: return None
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM webhook_state WHERE id = 1")
+        row = await conn.fetchrow(
+            "SELECT id, subscription_id, verify_token, created_at FROM webhook_state WHERE id = 1"
+        )
         return dict(row) if row else None
 
 
 # --- Analytics ---
 
+# How old the model_stats_mv rollup may get before a stats call schedules a
+# refresh. Callers are served the stale row; the refresh runs in the background.
+MODEL_STATS_MAX_AGE = timedelta(minutes=15)
+# Advisory lock key so only one worker process refreshes at a time
+_MODEL_STATS_LOCK = 0x6D6F64656C
+# Running refresh in this process, if any (also keeps the task referenced)
+_model_stats_refresh: Optional[asyncio.Task] = None
+
+_SQL_DATASET_STATS = """
+    SELECT
+        (SELECT COUNT(*) FROM data_consent WHERE opted_in = TRUE) AS consent_count,
+        (SELECT COUNT(*) FROM training_snapshots) AS snapshot_count,
+        (SELECT COUNT(*) FROM race_results) AS result_count,
+        (SELECT COUNT(*) FROM pending_predictions WHERE status = 'pending') AS pending_count,
+        (SELECT COUNT(*) FROM training_log) AS log_count,
+        (SELECT COUNT(*) FROM users) AS user_count,
+        (SELECT COUNT(*) FROM goal_races WHERE status = 'active') AS goal_race_count,
+        mv.n, mv.mae, mv.mape, mv.median_error, mv.p90_error,
+        mv.refreshed_at < NOW() - $1::interval AS stale
+    FROM model_stats_mv mv
+"""
+
+
+async def _refresh_model_stats():
+    try:
+        async with pool.acquire() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", _MODEL_STATS_LOCK):
+                return
+            try:
+                await conn.execute(
+                    "REFRESH MATERIALIZED VIEW CONCURRENTLY model_stats_mv",
+                    timeout=PG_LONG_COMMAND_TIMEOUT,
+                )
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", _MODEL_STATS_LOCK)
+    except Exception as e:
+        print(f"model_stats_mv refresh failed: {e}")
+
+
 async def get_dataset_stats() -> dict:
+    global _model_stats_refresh
     if not pool: return {"enabled": False}
     async with pool.acquire() as conn:
-        consent_count = await conn.fetchval("SELECT COUNT(*) FROM data_consent WHERE opted_in = TRUE")
-        snapshot_count = await conn.fetchval("SELECT COUNT(*) FROM training_snapshots")
-        result_count = await conn.fetchval("SELECT COUNT(*) FROM race_results")
-        pending_count = await conn.fetchval("SELECT COUNT(*) FROM pending_predictions WHERE status = 'pending'")
-        log_count = await conn.fetchval("SELECT COUNT(*) FROM training_log")
-        user_count = await conn.fetchval("SELECT COUNT(*) FROM users")
-        goal_race_count = await conn.fetchval("SELECT COUNT(*) FROM goal_races WHERE status = 'active'")
-
-        error_stats = await conn.fetchrow("""
-            SELECT COUNT(*) as n,
-                AVG(ABS(prediction_error_seconds)) as mae,
-                AVG(ABS(prediction_error_pct)) as mape,
-                PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY ABS(prediction_error_seconds)) as median_error,
-                PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY ABS(prediction_error_seconds)) as p90_error
-            FROM race_results WHERE predicted_time_seconds IS NOT NULL
-        """)
+        stats = await conn.fetchrow(_SQL_DATASET_STATS, MODEL_STATS_MAX_AGE)
+    if stats["stale"] and (_model_stats_refresh is None or _model_stats_refresh.done()):
+        _model_stats_refresh = asyncio.create_task(_refresh_model_stats())
 
-        return {
-            "enabled": True,
-            "opted_in_users": consent_count,
-            "training_snapshots": snapshot_count,
-            "race_results": result_count,
-            "pending_predictions": pending_count,
-            "training_log_entries": log_count,
-            "dashboard_users": user_count,
-            "active_goal_races": goal_race_count,
-            "model_accuracy": {
-                "sample_count": error_stats["n"] if error_stats else 0,
-                "mae_seconds": round(error_stats["mae"], 1) if error_stats and error_stats["mae"] else None,
-                "mape": round(error_stats["mape"], 2) if error_stats and error_stats["mape"] else None,
-                "median_error_seconds": round(error_stats["median_error"], 1) if error_stats and error_stats["median_error"] else None,
-                "p90_error_seconds": round(error_stats["p90_error"], 1) if error_stats and error_stats["p90_error"] else None,
-            },
-        }
+    return {
+        "enabled": True,
+        "opted_in_users": stats["consent_count"],
+        "training_snapshots": stats["snapshot_count"],
+        "race_results": stats["result_count"],
+        "pending_predictions": stats["pending_count"],
+        "training_log_entries": stats["log_count"],
+        "dashboard_users": stats["user_count"],
+        "active_goal_races": stats["goal_race_count"],
+        "model_accuracy": {
+            "sample_count": stats["n"],
+            "mae_seconds": round(stats["mae"], 1) if stats["mae"] else None,
+            "mape": round(stats["mape"], 2) if stats["mape"] else None,
+            "median_error_seconds": round(stats["median_error"], 1) if stats["median_error"] else None,
+            "p90_error_seconds": round(stats["p90_error"], 1) if stats["p90_error"] else None,
+        },
+    }
 
 
-async def export_training_dataset() -> list:
-    if not pool: return []
+_SQL_EXPORT_DATASET = """
+    SELECT
+        ts.weeks_of_data, ts.avg_weekly_miles, ts.peak_weekly_miles,
+        ts.total_miles, ts.total_runs, ts.avg_run_distance_mi,
+        ts.longest_run_mi, ts.avg_pace_per_mile_sec,
+        ts.fastest_pace_per_mile_sec, ts.total_elevation_gain_ft,
+        ts.avg_elevation_per_run_ft, ts.runs_with_heartrate,
+        ts.avg_heartrate, ts.weekly_mileage_progression,
+        ts.age_bucket, ts.experience_level, ts.gender,
+        rr.ref_distance_km, rr.ref_time_seconds,
+        rr.goal_distance_km, rr.goal_time_seconds,
+        rr.goal_elevation_gain_ft,
+        rr.predicted_time_seconds, rr.prediction_error_seconds,
+        rr.prediction_error_pct, rr.model_version, rr.source
+    FROM race_results rr
+    JOIN training_snapshots ts ON ts.id = rr.snapshot_id
+    ORDER BY rr.created_at
+"""
+
+
+async def export_training_dataset() -> AsyncIterator[dict]:
+    """
+    Yield the joined snapshot + race-result records one at a time.
+    Rows come from a server-side cursor, so memory stays flat however
+    large the dataset gets.
+    """
+    if not pool: return
     async with pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT
-                ts.weeks_of_data, ts.avg_weekly_miles, ts.peak_weekly_miles,
-                ts.total_miles, ts.total_runs, ts.avg_run_distance_mi,
-                ts.longest_run_mi, ts.avg_pace_per_mile_sec,
-                ts.fastest_pace_per_mile_sec, ts.total_elevation_gain_ft,
-                ts.avg_elevation_per_run_ft, ts.runs_with_heartrate,
-                ts.avg_heartrate, ts.weekly_mileage_progression,
-                ts.age_bucket, ts.experience_level, ts.gender,
-                rr.ref_distance_km, rr.ref_time_seconds,
-                rr.goal_distance_km, rr.goal_time_seconds,
-                rr.goal_elevation_gain_ft,
-                rr.predicted_time_seconds, rr.prediction_error_seconds,
-                rr.prediction_error_pct, rr.model_version, rr.source
-            FROM race_results rr
-            JOIN training_snapshots ts ON ts.id = rr.snapshot_id
-            ORDER BY rr.created_at
-        """)
-        return [dict(r) for r in rows]
+        async with conn.transaction():
+            async for r in conn.cursor(
+                    _SQL_EXPORT_DATASET, prefetch=1000, timeout=PG_LONG_COMMAND_TIMEOUT):
+                yield dict(r)
+
+
+async def export_training_dataset_csv(output) -> None:
+    """
+    COPY the export query out of Postgres as CSV with a header row.
+    `output` is an async callable that receives raw byte chunks as the
+    server produces them. No per-row Python objects are built, and the CSV
+    loads straight into pandas/pyarrow columns downstream.
+    """
+    if not pool: return
+    async with pool.acquire() as conn:
+        await conn.copy_from_query(
+            _SQL_EXPORT_DATASET, output=output, format="csv", header=True,
+            timeout=PG_LONG_COMMAND_TIMEOUT,
+        )
 
 
 # --- Users ---
@@ -754,7 +998,7 @@ async def create_goal_race(
             RETURNING *
         """,
             user_id, name, distance_km,
-            datetime.strptime(race_date, "%Y-%m-%d").date() if race_date else None,
+            date.fromisoformat(race_date) if race_date else None,
             goal_time_seconds,
             baseline_distance_km, baseline_time_seconds,
             experience, age,
@@ -1,41 +1,62 @@
 import os
+import time
+import hashlib
+import functools
+import random
+import asyncio
 import uuid
+import weakref
+import heapq
 import httpx
+import orjson
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+from operator import itemgetter
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict
 from typing import Optional
 
+# Load .env before the local modules read their config at import time
+load_dotenv()
+
 from database import (
     init_db, close_db, get_consent, set_consent,
     delete_athlete_data, store_training_snapshot, store_race_result,
-    get_dataset_stats, export_training_dataset,
+    get_dataset_stats, export_training_dataset, export_training_dataset_csv,
     store_tokens, store_pending_prediction, expire_old_predictions,
     store_webhook_state, get_webhook_state,
     get_or_create_user, get_user_by_strava_id,
     create_goal_race, get_active_goal_races, get_goal_race,
     update_goal_race_status, delete_goal_race,
     store_prediction, get_prediction_history, get_latest_prediction,
-    get_training_summary,
+    get_training_summary, migrate_training_log_generated, PG_LONG_COMMAND_TIMEOUT,
 )
-from prediction_engine import calculate_prediction, format_time, DISTANCES, EXPERIENCE_FACTORS
+from prediction_engine import calculate_prediction, format_time, DISTANCES, EXPERIENCE_FACTORS, KM_PER_MI
 from training_processor import process_training_data, detect_race_results
 from webhook_handler import process_activity_event
 
-load_dotenv()
-
 
 # --- App Lifecycle ---
 
+# Shared Strava client: keeps TLS connections alive across requests
+http_client: Optional[httpx.AsyncClient] = None
+
+
 @asynccontextmanager
 async def lifespan(app):
+    global http_client
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=128, max_keepalive_connections=64),
+        timeout=httpx.Timeout(10.0, connect=5.0),
+    )
     await init_db()
     yield
     await close_db()
+    await http_client.aclose()
 
 
 app = FastAPI(title="Race Prophet API", lifespan=lifespan)
@@ -46,23 +67,23 @@ STRAVA_CLIENT_SECRET = os.environ.get("STRAVA_CLIENT_SECRET", "")
 FRONTEND_URL = os.environ.get("FRONTEND_URL", "http://localhost:5173")
 WEBHOOK_VERIFY_TOKEN = os.environ.get("WEBHOOK_VERIFY_TOKEN", str(uuid.uuid4()))
 
+# Explicit allowlist (the only browser client is the frontend) so preflight
+# responses are static and browsers can cache them for a day
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[FRONTEND_URL],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PATCH", "DELETE"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
 # --- Strava OAuth ---
 
-@app.get("/api/strava/auth-url")
-def get_auth_url():
-    if not STRAVA_CLIENT_ID:
-        raise HTTPException(status_code=500, detail="STRAVA_CLIENT_ID not configured")
+def _build_auth_url() -> str:
     redirect_uri = f"{FRONTEND_URL}/callback"
     scope = "read,activity:read_all,profile:read_all"
-    url = (
+    return (
         f"https://www.strava.com/oauth/authorize"
         f"?client_id={STRAVA_CLIENT_ID}"
         f"&response_type=code"
@@ -70,24 +91,37 @@ def get_auth_url():
         f"&approval_prompt=auto"
         f"&scope={scope}"
     )
-    return {"url": url}
+
+
+# Both bodies depend only on config, so they're serialised once at import
+_AUTH_URL_BODY = orjson.dumps({"url": _build_auth_url()})
+_HEALTH_BODY = orjson.dumps({"status": "ok", "strava_configured": bool(STRAVA_CLIENT_ID)})
+
+
+@app.get("/api/strava/auth-url")
+def get_auth_url():
+    if not STRAVA_CLIENT_ID:
+        raise HTTPException(status_code=500, detail="STRAVA_CLIENT_ID not configured")
+    return Response(
+        _AUTH_URL_BODY, media_type="application/json",
+        headers={"Cache-Control": "public, max-age=300"},
+    )
 
 
 @app.post("/api/strava/token")
 async def exchange_token(code: str = Query(...)):
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            "https://www.strava.com/oauth/token",
-            data={
-                "client_id": STRAVA_CLIENT_ID,
-                "client_secret": STRAVA_CLIENT_SECRET,
-                "code": code,
-                "grant_type": "authorization_code",
-            },
-        )
+    resp = await http_client.post(
+        "https://www.strava.com/oauth/token",
+        data={
+            "client_id": STRAVA_CLIENT_ID,
+            "client_secret": STRAVA_CLIENT_SECRET,
+            "code": code,
+            "grant_type": "authorization_code",
+        },
+    )
     if resp.status_code != 200:
         raise HTTPException(status_code=400, detail=f"Strava token error: {resp.text}")
-    data = resp.json()
+    data = orjson.loads(resp.content)
 
     # Store encrypted tokens for webhook use
     await store_tokens(
@@ -120,19 +154,18 @@ async def exchange_token(code: str = Query(...)):
 
 @app.post("/api/strava/refresh")
 async def refresh_token(refresh_token: str = Query(...)):
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            "https://www.strava.com/oauth/token",
-            data={
-                "client_id": STRAVA_CLIENT_ID,
-                "client_secret": STRAVA_CLIENT_SECRET,
-                "refresh_token": refresh_token,
-                "grant_type": "refresh_token",
-            },
-        )
+    resp = await http_client.post(
+        "https://www.strava.com/oauth/token",
+        data={
+            "client_id": STRAVA_CLIENT_ID,
+            "client_secret": STRAVA_CLIENT_SECRET,
+            "refresh_token": refresh_token,
+            "grant_type": "refresh_token",
+        },
+    )
     if resp.status_code != 200:
         raise HTTPException(status_code=400, detail="Token refresh failed")
-    data = resp.json()
+    data = orjson.loads(resp.content)
     return {
         "access_token": data["access_token"],
         "refresh_token": data["refresh_token"],
@@ -168,7 +201,7 @@ async def webhook_event(request: Request):
     Event types: activity.create, activity.update, activity.delete,
                  athlete.update, athlete.deauthorize
     """
-    body = await request.json()
+    body = orjson.loads(await request.body())
     print(f"Webhook event: {body}")
 
     object_type = body.get("object_type")
@@ -179,7 +212,7 @@ async def webhook_event(request: Request):
     # We only care about new or updated activities
     if object_type == "activity" and aspect_type in ("create", "update"):
         try:
-            result = await process_activity_event(athlete_id, object_id)
+            result = await process_activity_event(http_client, athlete_id, object_id)
             print(f"Webhook processing result: {result}")
         except Exception as e:
             print(f"Webhook processing error: {e}")
@@ -217,19 +250,18 @@ async def setup_webhook(admin_key: str = Query(...)):
         else:
             raise HTTPException(status_code=500, detail="WEBHOOK_CALLBACK_URL not configured")
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            "https://www.strava.com/api/v3/push_subscriptions",
-            data={
-                "client_id": STRAVA_CLIENT_ID,
-                "client_secret": STRAVA_CLIENT_SECRET,
-                "callback_url": callback_url,
-                "verify_token": WEBHOOK_VERIFY_TOKEN,
-            },
-        )
+    resp = await http_client.post(
+        "https://www.strava.com/api/v3/push_subscriptions",
+        data={
+            "client_id": STRAVA_CLIENT_ID,
+            "client_secret": STRAVA_CLIENT_SECRET,
+            "callback_url": callback_url,
+            "verify_token": WEBHOOK_VERIFY_TOKEN,
+        },
+    )
 
     if resp.status_code == 201:
-        data = resp.json()
+        data = orjson.loads(resp.content)
         await store_webhook_state(data["id"], WEBHOOK_VERIFY_TOKEN)
         return {"status": "created", "subscription_id": data["id"]}
     elif resp.status_code == 409:
@@ -246,39 +278,226 @@ async def webhook_status(admin_key: str = Query(...)):
         raise HTTPException(status_code=403, detail="Invalid admin key")
 
     # Check with Strava
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            "https://www.strava.com/api/v3/push_subscriptions",
-            params={
-                "client_id": STRAVA_CLIENT_ID,
-                "client_secret": STRAVA_CLIENT_SECRET,
-            },
-        )
+    resp = await http_client.get(
+        "https://www.strava.com/api/v3/push_subscriptions",
+        params={
+            "client_id": STRAVA_CLIENT_ID,
+            "client_secret": STRAVA_CLIENT_SECRET,
+        },
+    )
 
     local_state = await get_webhook_state()
     return {
-        "strava_subscriptions": resp.json() if resp.status_code == 200 else [],
+        "strava_subscriptions": orjson.loads(resp.content) if resp.status_code == 200 else [],
         "local_state": local_state,
     }
 
 
 # --- Strava Data ---
 
+# Retries for a 429 from Strava, and the longest we'll hold a request waiting
+STRAVA_MAX_RETRIES = 3
+STRAVA_MAX_RETRY_DELAY = 8.0
+# Strava's 15-minute and daily usage as last reported in response headers
+_strava_rate = {"usage": (0, 0), "limit": (100, 1000)}
+
+
+def _note_strava_rate(resp: httpx.Response):
+    usage = resp.headers.get("X-RateLimit-Usage")
+    limit = resp.headers.get("X-RateLimit-Limit")
+    if not usage or not limit:
+        return
+    try:
+        short_used, daily_used = map(int, usage.split(",")[:2])
+        short_limit, daily_limit = map(int, limit.split(",")[:2])
+    except ValueError:
+        return
+    _strava_rate["usage"] = (short_used, daily_used)
+    _strava_rate["limit"] = (short_limit, daily_limit)
+
+
+def _strava_retry_delay(resp: httpx.Response, attempt: int) -> Optional[float]:
+    """Seconds to back off before retrying a 429, or None if not worth waiting for."""
+    (short_used, daily_used), (short_limit, daily_limit) = _strava_rate["usage"], _strava_rate["limit"]
+    now = time.time()
+    if daily_used >= daily_limit:
+        return None
+    if short_used >= short_limit:
+        # 15-minute windows reset on the quarter hour
+        delay = 900 - now % 900
+    else:
+        retry_after = resp.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.isdigit() else 2 ** attempt
+    if delay > STRAVA_MAX_RETRY_DELAY:
+        return None
+    return delay * random.uniform(0.8, 1.2)
+
+
+async def strava_get(url: str, **kwargs) -> httpx.Response:
+    """GET from the Strava API, backing off and retrying on rate-limit responses."""
+    for attempt in range(STRAVA_MAX_RETRIES + 1):
+        resp = await http_client.get(url, **kwargs)
+        _note_strava_rate(resp)
+        if resp.status_code != 429 or attempt == STRAVA_MAX_RETRIES:
+            return resp
+        delay = _strava_retry_delay(resp, attempt)
+        if delay is None:
+            return resp
+        await asyncio.sleep(delay)
+
+
+def _token_digest(access_token: str) -> str:
+    """Key for per-token state (caches, call limits) that avoids holding the raw token."""
+    return hashlib.blake2b(access_token.encode(), digest_size=16).hexdigest()
+
+
+# Per-athlete cap on in-flight Strava calls, keyed by token digest. Entries
+# disappear once no request is holding the semaphore.
+STRAVA_CALLS_PER_ATHLETE = 4
+_athlete_slots: "weakref.WeakValueDictionary[str, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+
+
+def athlete_slot(access_token: str) -> asyncio.Semaphore:
+    key = _token_digest(access_token)
+    slot = _athlete_slots.get(key)
+    if slot is None:
+        slot = _athlete_slots[key] = asyncio.Semaphore(STRAVA_CALLS_PER_ATHLETE)
+    return slot
+
+
+# Activity pages fetched concurrently per round once an athlete spans >1 page
+ACTIVITY_PAGE_WAVE = 4
+# Caps in-flight activity page requests across all users (Strava rate limits)
+_activity_page_slots = asyncio.Semaphore(6)
+# Activity fields anything downstream reads; the rest (polylines, lat/lng,
+# splits, ...) is dropped as soon as a page is decoded
+ACTIVITY_FIELDS = (
+    "id", "name", "type", "start_date", "distance", "moving_time",
+    "total_elevation_gain", "average_heartrate", "workout_type",
+)
+
+
+async def fetch_activities(access_token: str, params: dict, per_page: int) -> tuple[list, bool]:
+    """
+    Fetch every page of /athlete/activities matching params.
+
+    Page 1 is requested alone since most windows fit on it; after that pages
+    go out ACTIVITY_PAGE_WAVE at a time, stopping at the first short page.
+    Only runs are kept, trimmed to ACTIVITY_FIELDS. Returns (activities,
+    complete); complete is False if Strava rejected a page, in which case
+    activities holds everything before that page.
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    slot = athlete_slot(access_token)
+
+    async def get_page(page: int):
+        async with slot, _activity_page_slots:
+            return await strava_get(
+                "https://www.strava.com/api/v3/athlete/activities",
+                headers=headers,
+                params={**params, "per_page": per_page, "page": page},
+            )
+
+    activities = []
+    page, wave = 1, 1
+    while True:
+        for resp in await asyncio.gather(*(get_page(p) for p in range(page, page + wave))):
+            if resp.status_code != 200:
+                return activities, False
+            batch = orjson.loads(resp.content)
+            activities.extend(
+                {k: act[k] for k in ACTIVITY_FIELDS if k in act}
+                for act in batch if act.get("type") == "Run"
+            )
+            if len(batch) < per_page:
+                return activities, True
+        page += wave
+        wave = ACTIVITY_PAGE_WAVE
+
+
+# Stale-while-revalidate cache for per-token Strava reads: entries are served
+# as-is while fresh, served and refreshed in the background once stale, and
+# refetched inline once expired. Keys hash the token so raw tokens aren't kept.
+STRAVA_CACHE_FRESH = 60
+STRAVA_CACHE_TTL = 300
+STRAVA_CACHE_MAX = 1024
+_strava_cache: dict = {}       # key -> (monotonic fetch time, response)
+_strava_refreshes: dict = {}   # key -> in-flight background refresh task
+
+
+def _strava_cache_key(kind: str, access_token: str, *args) -> str:
+    return ":".join((kind, _token_digest(access_token), *map(str, args)))
+
+
+# In-progress Strava loads, so concurrent identical requests share one fetch
+_inflight: dict = {}   # key -> future of the running load
+
+
+async def single_flight(key: str, load):
+    """Await load(), joining an identical load already in flight if there is one."""
+    fut = _inflight.get(key)
+    if fut is None:
+        fut = _inflight[key] = asyncio.ensure_future(load())
+
+        def forget(done):
+            if _inflight.get(key) is done:
+                del _inflight[key]
+        fut.add_done_callback(forget)
+    # Shielded so one caller disconnecting doesn't cancel the load for the rest
+    return await asyncio.shield(fut)
+
+
+def _store_strava_cache(key: str, value):
+    if key not in _strava_cache and len(_strava_cache) >= STRAVA_CACHE_MAX:
+        _strava_cache.pop(next(iter(_strava_cache)))
+    _strava_cache[key] = (time.monotonic(), value)
+
+
+async def _refresh_strava_cache(key: str, load):
+    try:
+        _store_strava_cache(key, await single_flight(key, load))
+    except Exception as e:
+        print(f"Background Strava refresh failed: {e}")
+    finally:
+        _strava_refreshes.pop(key, None)
+
+
+async def cached_strava(key: str, load):
+    """Return load()'s result through the stale-while-revalidate cache."""
+    entry = _strava_cache.get(key)
+    if entry:
+        age = time.monotonic() - entry[0]
+        if age < STRAVA_CACHE_TTL:
+            if age >= STRAVA_CACHE_FRESH and key not in _strava_refreshes:
+                _strava_refreshes[key] = asyncio.create_task(_refresh_strava_cache(key, load))
+            return entry[1]
+    value = await single_flight(key, load)
+    _store_strava_cache(key, value)
+    return value
+
+
 @app.get("/api/strava/athlete")
 async def get_athlete(access_token: str = Query(...)):
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
+    return await cached_strava(
+        _strava_cache_key("athlete", access_token),
+        lambda: _load_athlete(access_token),
+    )
+
+
+async def _load_athlete(access_token: str) -> dict:
+    async with athlete_slot(access_token):
+        resp = await strava_get(
             "https://www.strava.com/api/v3/athlete",
             headers={"Authorization": f"Bearer {access_token}"},
         )
     if resp.status_code != 200:
         raise HTTPException(status_code=400, detail="Failed to fetch athlete")
-    data = resp.json()
+    data = orjson.loads(resp.content)
 
     age = None
     if data.get("birthday"):
         try:
-            bday = datetime.strptime(data["birthday"], "%Y-%m-%d")
+            bday = datetime.fromisoformat(data["birthday"])
             age = (datetime.now() - bday).days // 365
         except Exception:
             pass
@@ -302,31 +521,19 @@ async def get_activities(
     access_token: str = Query(...),
     weeks: int = Query(default=12, ge=1, le=52),
 ):
-    after_ts = int((datetime.now() - timedelta(weeks=weeks)).timestamp())
-    all_activities = []
-    page = 1
+    return await cached_strava(
+        _strava_cache_key("activities", access_token, weeks),
+        lambda: _load_activities(access_token, weeks),
+    )
 
-    async with httpx.AsyncClient() as client:
-        while True:
-            resp = await client.get(
-                "https://www.strava.com/api/v3/athlete/activities",
-                headers={"Authorization": f"Bearer {access_token}"},
-                params={
-                    "after": after_ts,
-                    "per_page": 100,
-                    "page": page,
-                    "type": "Run",
-                },
-            )
-            if resp.status_code != 200:
-                raise HTTPException(status_code=400, detail="Failed to fetch activities")
-            batch = resp.json()
-            if not batch:
-                break
-            all_activities.extend(batch)
-            page += 1
-            if len(batch) < 100:
-                break
+
+async def _load_activities(access_token: str, weeks: int) -> dict:
+    after_ts = int((datetime.now() - timedelta(weeks=weeks)).timestamp())
+    all_activities, complete = await fetch_activities(
+        access_token, {"after": after_ts, "type": "Run"}, per_page=100,
+    )
+    if not complete:
+        raise HTTPException(status_code=400, detail="Failed to fetch activities")
 
     runs = []
     weekly_distances = {}
@@ -339,20 +546,26 @@ async def get_activities(
         time_sec = act["moving_time"]
         date = act["start_date"][:10]
 
-        dt = datetime.strptime(date, "%Y-%m-%d")
-        week_key = dt.strftime("%Y-W%W")
+        week_key = _week_key(date)
         weekly_distances[week_key] = weekly_distances.get(week_key, 0) + dist_km
 
+        if dist_km > 0:
+            pace_km = time_sec / dist_km
+            pace_per_mile = format_time(int(pace_km * KM_PER_MI))
+            pace_per_km = format_time(int(pace_km))
+        else:
+            pace_per_mile = pace_per_km = "N/A"
+
         run = {
             "id": act["id"],
             "name": act["name"],
             "date": date,
             "distance_km": round(dist_km, 2),
-            "distance_mi": round(dist_km / 1.60934, 2),
+            "distance_mi": round(dist_km / KM_PER_MI, 2),
             "time_seconds": time_sec,
             "time_formatted": format_time(time_sec),
-            "pace_per_mile": format_time(int(time_sec / dist_km * 1.60934)) if dist_km > 0 else "N/A",
-            "pace_per_km": format_time(int(time_sec / dist_km)) if dist_km > 0 else "N/A",
+            "pace_per_mile": pace_per_mile,
+            "pace_per_km": pace_per_km,
             "elevation_gain": act.get("total_elevation_gain", 0),
             "average_heartrate": act.get("average_heartrate"),
             "workout_type": act.get("workout_type"),
@@ -360,7 +573,7 @@ async def get_activities(
         run["is_race"] = act.get("workout_type") == 1
         runs.append(run)
 
-    weekly_miles = [d / 1.60934 for d in weekly_distances.values()] if weekly_distances else [0]
+    weekly_miles = [d / KM_PER_MI for d in weekly_distances.values()] if weekly_distances else [0]
     # Divide by total weeks requested, not just weeks with runs (zero weeks matter)
     avg_weekly_miles = sum(weekly_miles) / weeks
 
@@ -372,47 +585,69 @@ async def get_activities(
         "weeks_analyzed": weeks,
         "avg_weekly_miles": round(avg_weekly_miles, 1),
         "weekly_mileage": [
-            {"week": k, "miles": round(v / 1.60934, 1)}
+            {"week": k, "miles": round(v / KM_PER_MI, 1)}
             for k, v in sorted(weekly_distances.items())
         ],
         "races": sorted(races, key=lambda r: r["date"], reverse=True),
         "best_efforts": best_efforts,
-        "recent_runs": sorted(runs, key=lambda r: r["date"], reverse=True)[:20],
+        "recent_runs": heapq.nlargest(20, runs, key=itemgetter("date")),
     }
 
 
+@functools.lru_cache(maxsize=1024)
+def _week_key(day: str) -> str:
+    """Weekly mileage bucket ("2024-W07", Monday-start) for a YYYY-MM-DD date."""
+    return datetime.fromisoformat(day).strftime("%Y-W%W")
+
+
+# Best-effort distances, and how far (as a fraction) a run may be off one
+BEST_EFFORT_TARGETS = (
+    ("1 Mile", KM_PER_MI),
+    ("5K", 5.0),
+    ("10K", 10.0),
+    ("Half Marathon", 21.0975),
+    ("Marathon", 42.195),
+)
+BEST_EFFORT_TOLERANCE = 0.15
+
+
 def find_best_efforts(runs):
-    targets = {
-        "1 Mile": 1.60934,
-        "5K": 5.0,
-        "10K": 10.0,
-        "Half Marathon": 21.0975,
-        "Marathon": 42.195,
-    }
+    # One pass over the runs, tracking the fastest pace seen per target
+    fastest = {}
+    for r in runs:
+        dist_km = r["distance_km"]
+        for label, target_km in BEST_EFFORT_TARGETS:
+            if abs(dist_km - target_km) / target_km <= BEST_EFFORT_TOLERANCE:
+                pace = r["time_seconds"] / dist_km
+                if label not in fastest or pace < fastest[label][0]:
+                    fastest[label] = (pace, r)
+
     best = {}
-    for label, target_km in targets.items():
-        tolerance = 0.15
-        candidates = [
-            r for r in runs
-            if abs(r["distance_km"] - target_km) / target_km <= tolerance
-        ]
-        if candidates:
-            fastest = min(candidates, key=lambda r: r["time_seconds"] / r["distance_km"])
+    for label, target_km in BEST_EFFORT_TARGETS:
+        if label in fastest:
+            run = fastest[label][1]
             best[label] = {
                 "distance_km": target_km,
-                "actual_distance_km": fastest["distance_km"],
-                "time_seconds": fastest["time_seconds"],
-                "time_formatted": fastest["time_formatted"],
-                "date": fastest["date"],
-                "name": fastest["name"],
-                "pace_per_mile": fastest["pace_per_mile"],
+                "actual_distance_km": run["distance_km"],
+                "time_seconds": run["time_seconds"],
+                "time_formatted": run["time_formatted"],
+                "date": run["date"],
+                "name": run["name"],
+                "pace_per_mile": run["pace_per_mile"],
             }
     return best
 
 
+# --- Request Models ---
+
+class RequestModel(BaseModel):
+    """Base for request bodies: immutable once parsed, unknown fields dropped."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+
 # --- Prediction Engine ---
 
-class PredictionRequest(BaseModel):
+class PredictionRequest(RequestModel):
     race_time_seconds: int
     race_distance_km: float
     goal_distance_km: float
@@ -435,7 +670,7 @@ def predict(req: PredictionRequest):
 
 # --- Data Collection Endpoints ---
 
-class ConsentRequest(BaseModel):
+class ConsentRequest(RequestModel):
     athlete_id: int
     opted_in: bool
 
@@ -458,7 +693,7 @@ async def delete_my_data(athlete_id: int = Query(...)):
     return {"status": "deleted"}
 
 
-class ContributeRequest(BaseModel):
+class ContributeRequest(RequestModel):
     athlete_id: int
     access_token: str
     ref_distance_km: float
@@ -474,7 +709,7 @@ class ContributeRequest(BaseModel):
 
 
 @app.post("/api/data/contribute")
-async def contribute_data(req: ContributeRequest):
+async def contribute_data(req: ContributeRequest, background: BackgroundTasks):
     """Store training snapshot + create pending prediction for webhook matching."""
     opted_in = await get_consent(req.athlete_id)
     if not opted_in:
@@ -482,25 +717,7 @@ async def contribute_data(req: ContributeRequest):
 
     # Fetch recent activities for training snapshot
     after_ts = int((datetime.now() - timedelta(weeks=16)).timestamp())
-    all_activities = []
-    page = 1
-
-    async with httpx.AsyncClient() as client:
-        while True:
-            resp = await client.get(
-                "https://www.strava.com/api/v3/athlete/activities",
-                headers={"Authorization": f"Bearer {req.access_token}"},
-                params={"after": after_ts, "per_page": 100, "page": page},
-            )
-            if resp.status_code != 200:
-                break
-            batch = resp.json()
-            if not batch:
-                break
-            all_activities.extend(batch)
-            page += 1
-            if len(batch) < 100:
-                break
+    all_activities, _ = await fetch_activities(req.access_token, {"after": after_ts}, per_page=100)
 
     training_data = process_training_data(all_activities, weeks=16)
 
@@ -525,8 +742,8 @@ async def contribute_data(req: ContributeRequest):
         goal_race_date=req.goal_race_date,
     )
 
-    # Clean up expired predictions
-    await expire_old_predictions()
+    # Clean up expired predictions once the response has been sent
+    background.add_task(expire_old_predictions)
 
     return {
         "status": "ok",
@@ -540,7 +757,7 @@ async def contribute_data(req: ContributeRequest):
     }
 
 
-class RaceResultRequest(BaseModel):
+class RaceResultRequest(RequestModel):
     athlete_id: int
     access_token: str
     snapshot_id: Optional[int] = None
@@ -592,26 +809,15 @@ async def check_for_race(
     goal_distance_km: float = Query(...),
     after_date: str = Query(...),
 ):
-    after_ts = int(datetime.strptime(after_date, "%Y-%m-%d").timestamp())
-    all_activities = []
-    page = 1
+    return await single_flight(
+        _strava_cache_key("check-race", access_token, goal_distance_km, after_date),
+        lambda: _find_race_matches(access_token, goal_distance_km, after_date),
+    )
 
-    async with httpx.AsyncClient() as client:
-        while True:
-            resp = await client.get(
-                "https://www.strava.com/api/v3/athlete/activities",
-                headers={"Authorization": f"Bearer {access_token}"},
-                params={"after": after_ts, "per_page": 50, "page": page},
-            )
-            if resp.status_code != 200:
-                break
-            batch = resp.json()
-            if not batch:
-                break
-            all_activities.extend(batch)
-            page += 1
-            if len(batch) < 50:
-                break
+
+async def _find_race_matches(access_token: str, goal_distance_km: float, after_date: str) -> dict:
+    after_ts = int(datetime.fromisoformat(after_date).timestamp())
+    all_activities, _ = await fetch_activities(access_token, {"after": after_ts}, per_page=50)
 
     matches = detect_race_results(all_activities, goal_distance_km)
     return {"matches": matches}
@@ -626,26 +832,65 @@ async def dataset_stats():
 
 
 @app.get("/api/data/export")
-async def dataset_export(admin_key: str = Query(...)):
+async def dataset_export(
+    admin_key: str = Query(...),
+    format: str = Query(default="json", pattern="^(json|csv)$"),
+):
     expected = os.environ.get("ADMIN_KEY", "")
     if not expected or admin_key != expected:
         raise HTTPException(status_code=403, detail="Invalid admin key")
-    data = await export_training_dataset()
-    return {"count": len(data), "records": data}
+    if format == "csv":
+        return StreamingResponse(_stream_export_csv(), media_type="text/csv")
+    return StreamingResponse(_stream_export(), media_type="application/json")
+
+
+async def _stream_export():
+    """
+    Encode export records as they arrive instead of building the full list.
+    orjson writes any date/datetime columns as ISO 8601 strings.
+    """
+    count = 0
+    yield b'{"records": ['
+    async for record in export_training_dataset():
+        yield (b"," if count else b"") + orjson.dumps(record)
+        count += 1
+    yield b'], "count": %d}' % count
+
+
+async def _stream_export_csv():
+    """Relay COPY ... CSV chunks from the database to the client as they arrive."""
+    chunks = asyncio.Queue(maxsize=16)
+
+    async def produce():
+        try:
+            await export_training_dataset_csv(chunks.put)
+        except Exception as e:
+            await chunks.put(e)
+            return
+        await chunks.put(None)
+
+    task = asyncio.create_task(produce())
+    try:
+        while (chunk := await chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        task.cancel()
 
 
 # --- Dashboard / Goal Race Endpoints ---
 
 async def get_current_user(access_token: str) -> dict:
     """Fetch athlete from Strava, then get or create local user."""
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
+    async with athlete_slot(access_token):
+        resp = await strava_get(
             "https://www.strava.com/api/v3/athlete",
             headers={"Authorization": f"Bearer {access_token}"},
         )
     if resp.status_code != 200:
         raise HTTPException(status_code=401, detail="Invalid Strava token")
-    athlete = resp.json()
+    athlete = orjson.loads(resp.content)
     user = await get_or_create_user(
         strava_athlete_id=athlete["id"],
         firstname=athlete.get("firstname", ""),
@@ -657,7 +902,7 @@ async def get_current_user(access_token: str) -> dict:
     return user
 
 
-class GoalRaceCreate(BaseModel):
+class GoalRaceCreate(RequestModel):
     name: str
     distance_km: float
     baseline_distance_km: float
@@ -669,7 +914,7 @@ class GoalRaceCreate(BaseModel):
     weekly_miles: Optional[float] = None
 
 
-class GoalRaceUpdate(BaseModel):
+class GoalRaceUpdate(RequestModel):
     status: str  # 'completed' | 'cancelled'
 
 
@@ -710,17 +955,18 @@ async def create_goal_race_endpoint(req: GoalRaceCreate, access_token: str = Que
         weekly_miles=req.weekly_miles or 0,
         age=req.age or 0,
         experience=req.experience or "intermediate",
+        include_equivalents=False,
     )
 
     await store_prediction(
         goal_race_id=race["id"],
         user_id=user["id"],
-        predicted_seconds=pred["predicted_seconds"],
-        low_seconds=pred["low_seconds"],
-        high_seconds=pred["high_seconds"],
-        uncertainty_pct=pred["uncertainty_pct"],
-        pace_per_mile=pred["pace_per_mile"],
-        pace_per_km=pred["pace_per_km"],
+        predicted_seconds=pred.predicted_seconds,
+        low_seconds=pred.low_seconds,
+        high_seconds=pred.high_seconds,
+        uncertainty_pct=pred.uncertainty_pct,
+        pace_per_mile=pred.pace_per_mile,
+        pace_per_km=pred.pace_per_km,
         avg_weekly_miles=req.weekly_miles,
         triggered_by="manual",
     )
@@ -786,7 +1032,7 @@ async def get_training_endpoint(
 
 @app.get("/api/health")
 def health():
-    return {"status": "ok", "strava_configured": bool(STRAVA_CLIENT_ID)}
+    return Response(_HEALTH_BODY, media_type="application/json")
 
 
 @app.post("/api/admin/migrate")
@@ -807,15 +1053,35 @@ async def run_migrations(admin_key: str = Query(...)):
         "ALTER TABLE pending_predictions ADD COLUMN IF NOT EXISTS match_window_days INT DEFAULT 3",
         "ALTER TABLE training_log ADD COLUMN IF NOT EXISTS user_id INT REFERENCES users(id)",
         "ALTER TABLE training_log ADD COLUMN IF NOT EXISTS activity_name TEXT",
+        """ALTER TABLE training_snapshots
+            ALTER COLUMN weeks_of_data TYPE SMALLINT,
+            ALTER COLUMN total_runs TYPE SMALLINT,
+            ALTER COLUMN runs_with_heartrate TYPE SMALLINT""",
+        # Paces are unbounded (GPS glitches, walks with tiny distances), so
+        # they stay INT; this also widens them back where they were narrowed
+        """ALTER TABLE training_snapshots
+            ALTER COLUMN avg_pace_per_mile_sec TYPE INT,
+            ALTER COLUMN fastest_pace_per_mile_sec TYPE INT""",
+        "DROP INDEX IF EXISTS idx_training_log_athlete",
+        "DROP INDEX IF EXISTS idx_pending_athlete",
+        "DROP INDEX IF EXISTS idx_pending_status",
     ]
 
+    # All or nothing: a failure part-way rolls every statement back rather
+    # than leaving tables without columns or indexes
     results = []
     async with pool.acquire() as conn:
-        for sql in migrations:
-            try:
-                await conn.execute(sql)
-                results.append({"sql": sql, "status": "ok"})
-            except Exception as e:
-                results.append({"sql": sql, "status": "error", "detail": str(e)})
+        try:
+            async with conn.transaction():
+                for sql in migrations:
+                    await conn.execute(sql, timeout=PG_LONG_COMMAND_TIMEOUT)
+                    results.append({"sql": sql, "status": "ok"})
+                # Normally already done by create_tables at startup
+                sql = "training_log generated columns"
+                converted = await migrate_training_log_generated(conn)
+                results.append({"sql": sql, "status": "ok" if converted else "already applied"})
+        except Exception as e:
+            results.append({"sql": sql, "status": "error", "detail": str(e)})
+            return {"migrations": results, "rolled_back": True}
 
-    return {"migrations": results}
\ No newline at end of file
+    return {"migrations": results, "rolled_back": False}
\ No newline at end of file
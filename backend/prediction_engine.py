@@ -4,9 +4,13 @@ Pure functions only — no FastAPI or database dependencies.
 """
 
 import math
+import functools
+from dataclasses import dataclass
+
+KM_PER_MI = 1.60934
 
 DISTANCES = {
-    "1 Mile": 1.60934,
+    "1 Mile": KM_PER_MI,
     "5K": 5.0,
     "10K": 10.0,
     "15K": 15.0,
@@ -15,6 +19,9 @@ DISTANCES = {
     "50K": 50.0,
 }
 
+# Seconds-per-km to seconds-per-mile factor for each of DISTANCES, in order
+_PACE_FACTORS = tuple(KM_PER_MI / dist for dist in DISTANCES.values())
+
 EXPERIENCE_FACTORS = {
     "beginner": 1.06,
     "intermediate": 1.0,
@@ -23,6 +30,28 @@ EXPERIENCE_FACTORS = {
 }
 
 
+@dataclass(frozen=True, slots=True)
+class Equivalent:
+    time_seconds: int
+    time_formatted: str
+    pace_per_mile: str
+
+
+@dataclass(frozen=True, slots=True)
+class Prediction:
+    predicted_seconds: int
+    predicted_formatted: str
+    low_seconds: int
+    low_formatted: str
+    high_seconds: int
+    high_formatted: str
+    uncertainty_pct: float
+    pace_per_mile: str
+    pace_per_km: str
+    equivalents: dict[str, Equivalent]
+
+
+@functools.lru_cache(maxsize=16384)
 def format_time(total_seconds):
     total_seconds = int(round(total_seconds))
     h = total_seconds // 3600
@@ -33,18 +62,8 @@ def format_time(total_seconds):
     return f"{m}:{s:02d}"
 
 
-def calculate_prediction(
-    race_time_seconds: int,
-    race_distance_km: float,
-    goal_distance_km: float,
-    weekly_miles: float = 0,
-    age: int = 0,
-    experience: str = "intermediate",
-) -> dict:
-    """
-    Riegel formula with training volume, age, and experience adjustments.
-    Returns dict with predicted time, confidence range, pace, and equivalents.
-    """
+def _volume_exponent(weekly_miles: float) -> float:
+    """Riegel exponent, lowered for high training volume and raised for low."""
     exponent = 1.06
 
     if weekly_miles:
@@ -57,8 +76,10 @@ def calculate_prediction(
         elif weekly_miles < 15:
             exponent += 0.02
 
-    exp_factor = EXPERIENCE_FACTORS.get(experience, 1.0)
+    return exponent
 
+
+def _age_factor(age: int) -> float:
     age_factor = 1.0
     if age and age > 0:
         if age < 20:
@@ -73,37 +94,82 @@ def calculate_prediction(
             age_factor = 1.10 + (age - 55) * 0.008
         else:
             age_factor = 1.18 + (age - 65) * 0.01
+    return age_factor
 
-    raw = race_time_seconds * math.pow(
-        goal_distance_km / race_distance_km, exponent
-    )
-    adjusted = raw * exp_factor * age_factor
+
+@functools.lru_cache(maxsize=4096)
+def _riegel(
+    race_time_seconds: int,
+    race_distance_km: float,
+    goal_distance_km: float,
+    exponent: float,
+    exp_factor: float,
+    age_factor: float,
+) -> tuple:
+    """
+    Adjusted goal time, uncertainty, and adjusted times for each of DISTANCES.
+    Memoised on the derived factors rather than the raw weekly mileage, age
+    and experience, so users whose inputs land in the same bands share entries.
+    """
+    # Every adjusted time is scale * distance ** exponent; the terms that
+    # don't depend on the target distance are folded in once here
+    scale = race_time_seconds * exp_factor * age_factor / race_distance_km ** exponent
+    adjusted = scale * goal_distance_km ** exponent
 
     dist_ratio = goal_distance_km / race_distance_km
     uncertainty = min(0.06, 0.03 + abs(math.log(dist_ratio)) * 0.008)
 
-    pace_per_mile = (adjusted / goal_distance_km) * 1.60934
+    return adjusted, uncertainty, tuple(scale * dist ** exponent for dist in DISTANCES.values())
+
+
+def calculate_prediction(
+    race_time_seconds: int,
+    race_distance_km: float,
+    goal_distance_km: float,
+    weekly_miles: float = 0,
+    age: int = 0,
+    experience: str = "intermediate",
+    include_equivalents: bool = True,
+) -> Prediction:
+    """
+    Riegel formula with training volume, age, and experience adjustments.
+    Returns predicted time, confidence range, pace, and equivalents; FastAPI
+    serialises the dataclasses to the same JSON shape the dicts had.
+    Callers that only store the goal prediction can skip the equivalents.
+    """
+    adjusted, uncertainty, equivalent_times = _riegel(
+        race_time_seconds, race_distance_km, goal_distance_km,
+        _volume_exponent(weekly_miles),
+        EXPERIENCE_FACTORS.get(experience, 1.0),
+        _age_factor(age),
+    )
+
     pace_per_km = adjusted / goal_distance_km
+    pace_per_mile = pace_per_km * KM_PER_MI
 
     equivalents = {}
-    for label, dist in DISTANCES.items():
-        eq_raw = race_time_seconds * math.pow(dist / race_distance_km, exponent)
-        eq_adj = eq_raw * exp_factor * age_factor
-        equivalents[label] = {
-            "time_seconds": round(eq_adj),
-            "time_formatted": format_time(round(eq_adj)),
-            "pace_per_mile": format_time(round((eq_adj / dist) * 1.60934)),
-        }
-
-    return {
-        "predicted_seconds": round(adjusted),
-        "predicted_formatted": format_time(round(adjusted)),
-        "low_seconds": round(adjusted * (1 - uncertainty)),
-        "low_formatted": format_time(round(adjusted * (1 - uncertainty))),
-        "high_seconds": round(adjusted * (1 + uncertainty)),
-        "high_formatted": format_time(round(adjusted * (1 + uncertainty))),
-        "uncertainty_pct": round(uncertainty * 100, 1),
-        "pace_per_mile": format_time(round(pace_per_mile)),
-        "pace_per_km": format_time(round(pace_per_km)),
-        "equivalents": equivalents,
-    }
+    if include_equivalents:
+        for label, eq_adj, pace_factor in zip(DISTANCES, equivalent_times, _PACE_FACTORS):
+            eq_seconds = round(eq_adj)
+            equivalents[label] = Equivalent(
+                eq_seconds,
+                format_time(eq_seconds),
+                format_time(round(eq_adj * pace_factor)),
+            )
+
+    predicted = round(adjusted)
+    low = round(adjusted * (1 - uncertainty))
+    high = round(adjusted * (1 + uncertainty))
+
+    return Prediction(
+        predicted_seconds=predicted,
+        predicted_formatted=format_time(predicted),
+        low_seconds=low,
+        low_formatted=format_time(low),
+        high_seconds=high,
+        high_formatted=format_time(high),
+        uncertainty_pct=round(uncertainty * 100, 1),
+        pace_per_mile=format_time(round(pace_per_mile)),
+        pace_per_km=format_time(round(pace_per_km)),
+        equivalents=equivalents,
+    )
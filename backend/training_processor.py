@@ -3,10 +3,14 @@ Process raw Strava activities into anonymized training features
 for storage in the database.
 """
 
-import json
-from datetime import datetime, timedelta
+import math
+import orjson
+from datetime import date
+from operator import itemgetter
 from typing import Optional
 
+from prediction_engine import KM_PER_MI
+
 
 def process_training_data(activities: list, weeks: int = 16) -> dict:
     """
@@ -26,73 +30,88 @@ def process_training_data(activities: list, weeks: int = 16) -> dict:
     if not runs:
         return _empty_snapshot(weeks)
 
-    # Calculate per-run stats
-    distances_mi = []
-    paces_sec_per_mile = []
-    elevations_ft = []
-    heartrates = []
+    # Per-run stats, reduced in a single pass
+    run_count = 0
+    total_miles = 0.0
+    longest_mi = 0.0
+    pace_sum = 0.0
+    fastest_pace = math.inf
+    elevation_sum = 0.0
+    hr_sum = 0.0
+    hr_count = 0
     weekly_distances = {}
 
     for run in runs:
-        dist_km = run.get("distance", 0) / 1000
-        dist_mi = dist_km / 1.60934
-        time_sec = run.get("moving_time", 0)
-        date_str = run.get("start_date", "")[:10]
+        get = run.get
+        dist_km = get("distance", 0) / 1000
+        time_sec = get("moving_time", 0)
 
         if dist_km <= 0 or time_sec <= 0:
             continue
 
-        distances_mi.append(dist_mi)
+        dist_mi = dist_km / KM_PER_MI
+        date_str = get("start_date", "")[:10]
+
+        run_count += 1
+        total_miles += dist_mi
+        if dist_mi > longest_mi:
+            longest_mi = dist_mi
 
         # Pace
-        pace = (time_sec / dist_km) * 1.60934  # sec per mile
-        paces_sec_per_mile.append(pace)
+        pace = (time_sec / dist_km) * KM_PER_MI  # sec per mile
+        pace_sum += pace
+        if pace < fastest_pace:
+            fastest_pace = pace
 
         # Elevation (meters -> feet)
-        elev = run.get("total_elevation_gain", 0) * 3.281
-        elevations_ft.append(elev)
+        elevation_sum += get("total_elevation_gain", 0) * 3.281
 
         # Heart rate
-        hr = run.get("average_heartrate")
+        hr = get("average_heartrate")
         if hr:
-            heartrates.append(hr)
+            hr_sum += hr
+            hr_count += 1
 
-        # Weekly buckets
+        # Weekly buckets, keyed by (year, ordinal of the week's Monday): the same
+        # grouping as strftime("%Y-W%W"), without formatting a label per run
         try:
-            dt = datetime.strptime(date_str, "%Y-%m-%d")
-            week_key = dt.strftime("%Y-W%W")
-            weekly_distances[week_key] = weekly_distances.get(week_key, 0) + dist_mi
-        except (ValueError, TypeError):
+            day = date.fromisoformat(date_str)
+        except ValueError:
             pass
+        else:
+            week = (day.year, day.toordinal() - day.weekday())
+            weekly_distances[week] = weekly_distances.get(week, 0) + dist_mi
 
-    if not distances_mi:
+    if not run_count:
         return _empty_snapshot(weeks)
 
     # Weekly mileage stats
-    weekly_miles = list(weekly_distances.values())
+    weekly_miles = weekly_distances.values()
     avg_weekly = sum(weekly_miles) / len(weekly_miles) if weekly_miles else 0
     peak_weekly = max(weekly_miles) if weekly_miles else 0
 
-    # Build weekly progression (sorted chronologically)
+    # Build weekly progression (sorted chronologically); labels are formatted
+    # once per week from its first day that falls inside the bucket's year
     sorted_weeks = sorted(weekly_distances.items())
-    weekly_progression = json.dumps([
-        {"week": w, "miles": round(m, 1)} for w, m in sorted_weeks
-    ])
+    weekly_progression = orjson.dumps([
+        {"week": _week_label(year, monday), "miles": round(m, 1)}
+        for (year, monday), m in sorted_weeks
+    ]).decode()
 
     return {
         "weeks_of_data": weeks,
         "avg_weekly_miles": round(avg_weekly, 1),
         "peak_weekly_miles": round(peak_weekly, 1),
-        "total_miles": round(sum(distances_mi), 1),
-        "total_runs": len(distances_mi),
-        "avg_run_distance_mi": round(sum(distances_mi) / len(distances_mi), 1),
-        "longest_run_mi": round(max(distances_mi), 1),
-        "avg_pace_per_mile_sec": round(sum(paces_sec_per_mile) / len(paces_sec_per_mile)),
-        "fastest_pace_per_mile_sec": round(min(paces_sec_per_mile)),
-        "total_elevation_gain_ft": round(sum(elevations_ft), 0),
-        "avg_elevation_per_run_ft": round(sum(elevations_ft) / len(elevations_ft), 0) if elevations_ft else 0,
-        "runs_with_heartrate": len(heartrates),
-        "avg_heartrate": round(sum(heartrates) / len(heartrates), 1) if heartrates else None,
+        "total_miles": round(total_miles, 1),
+        "total_runs": run_count,
+        "avg_run_distance_mi": round(total_miles / run_count, 1),
+        "longest_run_mi": round(longest_mi, 1),
+        "avg_pace_per_mile_sec": round(pace_sum / run_count),
+        "fastest_pace_per_mile_sec": round(fastest_pace),
+        "total_elevation_gain_ft": round(elevation_sum, 0),
+        "avg_elevation_per_run_ft": round(elevation_sum / run_count, 0),
+        "runs_with_heartrate": hr_count,
+        "avg_heartrate": round(hr_sum / hr_count, 1) if hr_count else None,
         "weekly_mileage_progression": weekly_progression,
     }
 
@@ -135,13 +154,18 @@ def detect_race_results(activities: list, goal_distance_km: float, tolerance: fl
                 "average_heartrate": act.get("average_heartrate"),
             })
 
-    # Sort: races first, then by date descending
-    matches.sort(key=lambda x: (not x["is_race"], x["date"]), reverse=False)
-    matches.sort(key=lambda x: x["date"], reverse=True)
+    # Sort: newest first, races ahead of other runs on the same day
+    matches.sort(key=itemgetter("date", "is_race"), reverse=True)
 
     return matches
 
 
+def _week_label(year: int, monday: int) -> str:
+    """Return the "%Y-W%W" label for a (year, Monday ordinal) weekly bucket."""
+    first_day = max(monday, date(year, 1, 1).toordinal())
+    return date.fromordinal(first_day).strftime("%Y-W%W")
+
+
 def _empty_snapshot(weeks: int) -> dict:
     """Return empty training snapshot."""
     return {
@@ -8,9 +8,12 @@ Two responsibilities:
 
 import os
 import time
+import asyncio
 import httpx
-from datetime import datetime, timedelta
+import orjson
+from datetime import date
 from typing import Optional
+from urllib.parse import quote, urlencode
 
 from database import (
     get_tokens, update_tokens, get_pending_predictions,
@@ -24,48 +27,51 @@ from prediction_engine import calculate_prediction
 STRAVA_CLIENT_ID = os.environ.get("STRAVA_CLIENT_ID", "")
 STRAVA_CLIENT_SECRET = os.environ.get("STRAVA_CLIENT_SECRET", "")
 
+# Token refresh form body is fixed apart from the refresh token, so encode it once
+STRAVA_TOKEN_URL = "https://www.strava.com/oauth/token"
+_REFRESH_BODY_PREFIX = urlencode({
+    "client_id": STRAVA_CLIENT_ID,
+    "client_secret": STRAVA_CLIENT_SECRET,
+    "grant_type": "refresh_token",
+}) + "&refresh_token="
+_FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
 
-async def refresh_athlete_token(athlete_id: int) -> Optional[str]:
+
+async def refresh_athlete_token(client: httpx.AsyncClient, athlete_id: int) -> Optional[str]:
     tokens = await get_tokens(athlete_id)
     if not tokens:
         return None
     if tokens["expires_at"] > time.time() + 300:
         return tokens["access_token"]
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            "https://www.strava.com/oauth/token",
-            data={
-                "client_id": STRAVA_CLIENT_ID,
-                "client_secret": STRAVA_CLIENT_SECRET,
-                "refresh_token": tokens["refresh_token"],
-                "grant_type": "refresh_token",
-            },
-        )
+    resp = await client.post(
+        STRAVA_TOKEN_URL,
+        content=(_REFRESH_BODY_PREFIX + quote(tokens["refresh_token"], safe="")).encode(),
+        headers=_FORM_HEADERS,
+    )
     if resp.status_code != 200:
         print(f"Token refresh failed for athlete {athlete_id}: {resp.text}")
         return None
 
-    data = resp.json()
+    data = orjson.loads(resp.content)
     await update_tokens(athlete_id, data["access_token"], data["refresh_token"], data["expires_at"])
     return data["access_token"]
 
 
-async def fetch_activity(access_token: str, activity_id: int) -> Optional[dict]:
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"https://www.strava.com/api/v3/activities/{activity_id}",
-            headers={"Authorization": f"Bearer {access_token}"},
-        )
+async def fetch_activity(client: httpx.AsyncClient, access_token: str, activity_id: int) -> Optional[dict]:
+    resp = await client.get(
+        f"https://www.strava.com/api/v3/activities/{activity_id}",
+        headers={"Authorization": f"Bearer {access_token}"},
+    )
     if resp.status_code != 200:
         print(f"Failed to fetch activity {activity_id}: {resp.status_code}")
         return None
-    return resp.json()
+    return orjson.loads(resp.content)
 
 
-async def process_activity_event(athlete_id: int, activity_id: int) -> dict:
+async def process_activity_event(client: httpx.AsyncClient, athlete_id: int, activity_id: int) -> dict:
     """
-    Process a new activity from Strava webhook:
+    Process a new activity from Strava webhook, using the app's shared client:
     1. Always log the run to training_log (if opted in)
     2. Check if it matches a pending race prediction
     """
@@ -77,19 +83,22 @@ async def process_activity_event(athlete_id: int, activity_id: int) -> dict:
         "reason": "",
     }
 
-    # Check consent
+    # Check consent first: tokens are only read (and decrypted) for athletes who opted in
     if not await get_consent(athlete_id):
         result["reason"] = "not opted in"
         return result
 
     # Get a valid access token
-    access_token = await refresh_athlete_token(athlete_id)
+    access_token = await refresh_athlete_token(client, athlete_id)
     if not access_token:
         result["reason"] = "token refresh failed"
         return result
 
-    # Fetch the activity details
-    activity = await fetch_activity(access_token, activity_id)
+    # Fetch the activity details; pending predictions don't depend on it
+    activity, pending = await asyncio.gather(
+        fetch_activity(client, access_token, activity_id),
+        get_pending_predictions(athlete_id),
+    )
     if not activity:
         result["reason"] = "activity fetch failed"
         return result
@@ -113,29 +122,27 @@ async def process_activity_event(athlete_id: int, activity_id: int) -> dict:
     is_race = activity.get("workout_type") == 1
 
     try:
-        activity_date = datetime.strptime(activity_date_str, "%Y-%m-%d").date()
+        activity_date = date.fromisoformat(activity_date_str)
     except (ValueError, TypeError):
         return result
 
-    pending = await get_pending_predictions(athlete_id)
     if not pending:
         return result
 
+    # A run with no distance can't match any goal; skip straight to step 3
+    if dist_km <= 0:
+        pending = ()
+
     for pred in pending:
-        # Check distance match
+        # Check distance match (tolerance is a fraction of the goal distance)
         goal_km = pred["goal_distance_km"]
-        tolerance = pred["distance_tolerance"]
-        if dist_km <= 0 or abs(dist_km - goal_km) / goal_km > tolerance:
+        if abs(dist_km - goal_km) > pred["distance_tolerance"] * goal_km:
             continue
 
-        # If race date specified, only match within window
-        if pred.get("goal_race_date"):
-            race_date = pred["goal_race_date"]
-            window = pred.get("match_window_days", 3)
-            earliest = race_date - timedelta(days=1)
-            latest = race_date + timedelta(days=window)
-            if not (earliest <= activity_date <= latest):
-                continue
+        # If race date specified, only match within window (bounds come from SQL)
+        earliest = pred["match_earliest"]
+        if earliest is not None and not (earliest <= activity_date <= pred["match_latest"]):
+            continue
 
         # Match found!
         race_result_id = await store_race_result(
@@ -206,17 +213,18 @@ async def recalculate_goal_race_predictions(athlete_id: int, activity_id: int):
                 weekly_miles=avg_weekly_miles,
                 age=race.get("age") or 0,
                 experience=race.get("experience") or "intermediate",
+                include_equivalents=False,
             )
 
             await store_prediction(
                 goal_race_id=race["id"],
                 user_id=user["id"],
-                predicted_seconds=pred["predicted_seconds"],
-                low_seconds=pred["low_seconds"],
-                high_seconds=pred["high_seconds"],
-                uncertainty_pct=pred["uncertainty_pct"],
-                pace_per_mile=pred["pace_per_mile"],
-                pace_per_km=pred["pace_per_km"],
+                predicted_seconds=pred.predicted_seconds,
+                low_seconds=pred.low_seconds,
+                high_seconds=pred.high_seconds,
+                uncertainty_pct=pred.uncertainty_pct,
+                pace_per_mile=pred.pace_per_mile,
+                pace_per_km=pred.pace_per_km,
                 avg_weekly_miles=avg_weekly_miles,
                 total_runs=total_runs,
                 longest_run_mi=longest_run_mi,
@@ -225,6 +233,6 @@ async def recalculate_goal_race_predictions(athlete_id: int, activity_id: int):
             )
 
             print(f"Goal race prediction updated: race={race['name']}, "
-                  f"predicted={pred['predicted_formatted']}, weekly_miles={avg_weekly_miles}")
+                  f"predicted={pred.predicted_formatted}, weekly_miles={avg_weekly_miles}")
         except Exception as e:
             print(f"Failed to recalculate for goal race {race['id']}: {e}")
\ No newline at end of file